@@ -1,20 +1,37 @@
 #!/usr/bin/env python
 
 import argparse
+import atexit
 import datetime
-import fileinput
 import os
 import re
 import shared
-import shutil
 import subprocess
 import sys
 import time
 import warnings
 
+from multiprocessing.pool import ThreadPool
+
+from artifactcache import ArtifactCache
 from buildaudit import BuildAudit
+from fingerprint import DEFAULT_TOOLS, DEFAULT_VARS, environment_fingerprint
 from gmakecommand import GMakeCommand
-from auditutils import run_with_stdin, svn_export_dirs, svn_get_url, recreate_dir, verbose, svn_full_extract
+from jobserver import JobServer
+from pathfixup import fixed_up, fixup_file, fixup_files
+from prefetch import Prefetcher, prefetch_order
+from recovery import fetch_missing
+from remotecache import RemoteCache
+from scopes import ScopeCoordinator
+from treeclean import clean_targets
+from treecopy import changed_files, copy_files, sync_tree
+from verify import compare_digests, compare_trees, prepare_tree, report
+from warmtree import SyncManifest, TreeCache
+from auditutils import parse_size, svn_export_dirs, svn_get_url, recreate_dir, verbose, svn_full_extract
+
+def words(text):
+  """Split a comma or space separated list."""
+  return text.replace(',', ' ').split() if isinstance(text, str) else text
 
 def main(argv):
   """Do an audited GNU make build, optionally copied to a different directory.
@@ -41,31 +58,87 @@ def main(argv):
   start_time = time.time()
 
   parser = argparse.ArgumentParser()
+  parser.add_argument('--artifact-budget', type=parse_size, default=os.getenv('AB_ARTIFACT_BUDGET'),
+          help='Evict least recently used artifact cache entries beyond this total size (e.g. 20G)')
+  parser.add_argument('--artifact-cache', default=os.getenv('AB_ARTIFACT_CACHE'),
+          help='Directory of a content-addressed cache of build targets, shared between trees')
+  parser.add_argument('--artifact-mode', choices=['copy', 'reflink', 'hardlink'],
+          default=os.getenv('AB_ARTIFACT_MODE', 'copy'),
+          help='How to put targets in place from the artifact cache (hardlink makes them read-only; root gets copies)')
+  parser.add_argument('--artifact-remote', default=os.getenv('AB_ARTIFACT_REMOTE'),
+          help='URL of a shared artifact cache (see AuditCacheServer) to use behind --artifact-cache')
+  parser.add_argument('--avoid-build', action='store_true',
+          help='Skip the build if no recorded prereq or target has changed since it was audited')
   parser.add_argument('-b', '--base-of-tree',
           help='Path to root of source tree')
+  parser.add_argument('--cache-budget', type=parse_size, default=os.getenv('AB_CACHE_BUDGET'),
+          help='Evict least recently used external trees beyond this total size (e.g. 50G)')
   parser.add_argument('-c', '--clean', action='store_true',
           help='Force a clean ahead of the build')
+  parser.add_argument('--clean-all-keys', action='store_true',
+          help='With --clean, remove the recorded targets of every key, not just this one')
+  parser.add_argument('--clean-dry-run', action='store_true',
+          help='Report what --clean would remove (files and bytes) and exit')
+  parser.add_argument('--copier', choices=['rsync', 'native'], default=os.getenv('AB_COPIER', 'rsync'),
+          help='Copy files to and from the external tree with rsync or the built-in parallel copier')
+  parser.add_argument('--copy-out-mode', choices=['copy', 'reflink', 'hardlink'],
+          default=os.getenv('AB_COPY_OUT_MODE', 'copy'),
+          help='Share file data with the external tree when on the same filesystem (implies --copier=native);'
+               ' hardlink shares only prereqs the last audit saw the build read but never write, and a build'
+               ' that writes through a link anyway fails afterwards with the source already modified')
   parser.add_argument('-D', '--dbname',
           help='Path to a database file')
+  parser.add_argument('--detach-commit', action='store_true',
+          help='Write the database from a background process instead of waiting for it')
+  parser.add_argument('--digests', action='store_true',
+          help='Record content hashes too, so --avoid-build can see past timestamp-only changes')
   parser.add_argument('-E', '--extract-dirs-with-fallback',
           help='Pre-populate the build tree from DB or BOM')
   parser.add_argument('-e', '--edit', action='store_true',
           help='Fix up generated text files: s/<external-base>//')
   parser.add_argument('-f', '--fresh', action='store_true',
           help='Regenerate data for current build from scratch')
+  parser.add_argument('--fingerprint', action='store_true',
+          help='Record the toolchain and environment, and require a match for --avoid-build and artifact caching')
+  parser.add_argument('--fingerprint-tools', type=words, default=os.getenv('AB_FINGERPRINT_TOOLS', DEFAULT_TOOLS),
+          help='Commands whose binaries go into the fingerprint (comma or space separated)')
+  parser.add_argument('--fingerprint-vars', type=words, default=os.getenv('AB_FINGERPRINT_VARS', DEFAULT_VARS),
+          help='Environment variables which go into the fingerprint (comma or space separated)')
   parser.add_argument('-k', '--key',
           help='A key to uniquely describe what was built')
+  parser.add_argument('--max-age', type=int, metavar='N',
+          help='With --merge, demote prereqs not read in the last N rebuilds, nor since every target was rebuilt')
+  parser.add_argument('--merge', action='store_true',
+          help='Fold the files read and written by incremental builds into the audit, not just fresh ones')
+  parser.add_argument('--parent-key',
+          help='With --scope, also fold the results into this key of the parent database')
+  parser.add_argument('--mtime-only', action='store_true',
+          help='On a noatime mount, copy back and record just the files written, keeping the old prereqs')
   parser.add_argument('-p', '--prebuild', action='append',
           default=['test ! -d src/include || REUSE_VERSION=1 make -C src/include'],
           help='Setup command(s) to be run prior to the build proper')
+  parser.add_argument('--recover', type=int, default=0, metavar='N',
+          help='Retry failed incremental external builds up to N times after copying reported missing inputs')
+  parser.add_argument('--prefetch', action='store_true',
+          help='Warm the page cache with the recorded prereqs while the build starts')
   parser.add_argument('-R', '--remove-external-tree', action='store_true',
           help='Remove the external build tree before exiting')
   parser.add_argument('-r', '--retry-in-place', action='store_true',
           help='Retry failed external builds in the current directory')
+  parser.add_argument('--resume-in-place', action='store_true',
+          help='Like --retry-in-place, but first copy back whatever the external build completed')
+  parser.add_argument('--scope',
+          help='Audit only this subdirectory, allowing concurrent audits of other subdirectories')
+  parser.add_argument('-S', '--skip-identical', action='store_true',
+          help='Copy back only targets whose contents differ from the source tree')
   parser.add_argument('-U', '--base-url',
           help='The svn URL from which to get files')
   parser.add_argument('-v', '--verbosity', type=int,
           help='Change the amount of verbosity')
+  parser.add_argument('--verify', action='store_true',
+          help='Rebuild in a second external tree (or compare with the last digests) to find volatile targets')
+  parser.add_argument('-W', '--warm', action='store_true',
+          help='Keep the external tree warm and copy out only files changed since the last sync')
   parser.add_argument('-X', '--execute-only', action='store_true',
           help='Skip the auditing and just exec the build command')
   parser.add_argument('-x', '--external-base',
@@ -86,6 +159,16 @@ def main(argv):
 
   cwd = os.getcwd()
 
+  scope = None
+  if opts.scope:
+    scope = os.path.relpath(os.path.abspath(opts.scope), base_dir)
+    if scope.startswith(os.pardir):
+      parser.error("the --scope directory must be within the base of the tree")
+  elif opts.parent_key:
+    parser.error("the --parent-key option makes no sense without --scope")
+  if opts.max_age is not None and not opts.merge:
+    parser.error("the --max-age option makes no sense without --merge")
+
   if opts.external_base or os.getenv('AB_EXTERNAL_BASE') is not None:
     xd = (opts.external_base if opts.external_base else os.getenv('AB_EXTERNAL_BASE'))
     external_base = os.path.abspath(xd)
@@ -101,10 +184,27 @@ def main(argv):
   bldcmd = GMakeCommand(opts.build_command)
   bldcmd.directory = bwd
 
-  if opts.dbname:
+  # Our own worker pools share the machine with make's jobs.
+  shared.jobs = bldcmd.jobs
+  shared.load_average = bldcmd.load_average
+  shared.jobserver = JobServer.from_auth(bldcmd.jobserver_auth)
+
+  coordinator = None
+  if scope and not (bldcmd.dry_run or bldcmd.special_case or opts.execute_only):
+    # Register before reading the database, which an overlapping
+    # audit may be about to rewrite.
+    coordinator = ScopeCoordinator(build_base, in_place=external_base is None)
+    coordinator.acquire(scope)
+    atexit.register(coordinator.release)
+
+  if scope:
+    # Each scope keeps its own database; -D names the parent's.
+    audit = BuildAudit(dbdir=opts.scope)
+  elif opts.dbname:
     audit = BuildAudit(opts.dbname)
   else:
     audit = BuildAudit(dbdir=bldcmd.subdir)
+  atexit.register(audit.hashes.save)
 
   key = opts.key if opts.key else bldcmd.tgtkey
 
@@ -131,22 +231,94 @@ def main(argv):
     rc = bldcmd.execute_in(cwd, start_time)
     sys.exit(rc)
 
-  if audit.has(key):
-    if opts.clean:
-      for tgt in audit.old_targets([key]):
-        try:
-          os.remove(os.path.join(build_base, tgt))
-        except OSError:
-          pass
-  else:
+  avoidable = opts.avoid_build
+  fingerprint = environment = None
+  if opts.fingerprint:
+    fingerprint, environment = environment_fingerprint(opts.fingerprint_tools, opts.fingerprint_vars,
+                                                       make=bldcmd.argv[0], hasher=audit.hashes)
+    if audit.has(key) and audit.fingerprint(key) != fingerprint:
+      verbose("Toolchain or environment changed since '%s' was audited" % (key))
+      avoidable = False
+
+  # A scoped audit sees only the files under its scope, so its
+  # prereqs can't vouch for what the build read from elsewhere.
+  partial = scope or audit.scoped(key)
+  if partial and (avoidable or opts.artifact_cache):
+    verbose("Scoped audit of '%s': not avoiding the build or using the artifact cache" % (key))
+    avoidable = False
+
+  if avoidable and audit.has(key) and not (opts.fresh or opts.clean or opts.clean_dry_run):
+    restore = audit.avoidable(key, base_dir, build_base)
+    if restore is not None:
+      if restore:
+        fixup = None
+        if opts.edit:
+          prefix = external_base + os.sep
+          fixup = lambda rpath: fixup_file(os.path.join(base_dir, rpath), prefix, '/')
+        copy_files(build_base, base_dir, restore, copier=opts.copier, label='Restore', on_copied=fixup)
+      verbose("Nothing to do for '%s'; %d prereqs unchanged" % (key, len(audit.old_prereqs([key]))))
+      sys.exit(0)
+
+  artifacts = None
+  if opts.artifact_remote and not opts.artifact_cache:
+    parser.error("the --artifact-remote option needs a local --artifact-cache")
+  if opts.artifact_cache and not partial:
+    remote = None
+    if opts.artifact_remote:
+      try:
+        remote = RemoteCache(opts.artifact_remote)
+      except ValueError as e:
+        parser.error(str(e))
+    artifacts = ArtifactCache(opts.artifact_cache, opts.artifact_budget, opts.artifact_mode, hasher=audit.hashes,
+                              remote=remote)
+    if audit.has(key) and not (opts.fresh or opts.clean or opts.clean_dry_run):
+      digest = artifacts.digest(key, bldcmd.argv, base_dir, audit.old_prereqs([key]), fingerprint,
+                                audit.old_volatile(audit.all_keys()))
+      if digest and artifacts.fetch(digest, base_dir) is not None:
+        sys.exit(0)
+
+  manifest = SyncManifest(build_base) if external_base and opts.warm else None
+
+  if external_base:
+    tree_cache = TreeCache(external_base)
+    tree_cache.acquire(build_base)
+
+  if opts.clean or opts.clean_dry_run:
+    clean_keys = audit.all_keys() if opts.clean_all_keys else [key]
+    doomed = audit.old_targets([k for k in clean_keys if audit.has(k)])
+    clean_targets(build_base, doomed, dry_run=opts.clean_dry_run)
+    if opts.clean_dry_run:
+      sys.exit(0)
+    if manifest:
+      manifest.forget(doomed)
+
+  if not audit.has(key):
     opts.fresh = True
 
+  out_copier = None
+  # Only inputs no build has been seen to write are safe to share.
+  linkable = audit.linkable_prereqs(key) if opts.copy_out_mode == 'hardlink' else ()
   if external_base:
-    copy_out_cmd = ['rsync', '-a']
-    if opts.fresh:
-      copy_out_cmd.append('--exclude=[.]svn*')
-      recreate_dir(bwd)
-      feed_to_rsync = []
+    excludes = ['*.swp', os.path.basename(audit.dbfile), os.path.basename(audit.hashes.path) + '*']
+    if scope:
+      # Other scopes may be building alongside, so keep out of
+      # their directories and bring the shared parts up to date one
+      # scope at a time; the prereqs recorded for a scope don't
+      # cover what it reads from outside it.
+      excludes.insert(0, '[.]svn*')
+      if opts.fresh and not manifest:
+        recreate_dir(os.path.normpath(os.path.join(build_base, scope)))
+      with coordinator.exclusive():
+        busy = ['/' + s + '/' for s in coordinator.others()]
+        if busy:
+          verbose("Copy-out: leaving %s to the audits building there" % (', '.join(busy)))
+        out_copier = sync_tree(base_dir, build_base, busy + excludes, delete=False, copier=opts.copier,
+                               label='Copy-out', mode=opts.copy_out_mode, linkable=linkable,
+                               manifest=manifest)
+    elif opts.fresh:
+      excludes.insert(0, '[.]svn*')
+      if not manifest:
+        recreate_dir(bwd)
       if False:
         svnstat = ['svn', 'status', '--no-ignore']
         verbose(svnstat)
@@ -160,24 +332,31 @@ def main(argv):
             continue
           if os.path.isdir(os.path.join(base_dir, rpath)):
             rpath += os.sep
-          feed_to_rsync.append(rpath)
-        copy_out_cmd.append('--exclude-from=-')
+          excludes.append(rpath)
+      out_copier = sync_tree(base_dir, build_base, excludes, delete=True, copier=opts.copier, label='Copy-out',
+                             mode=opts.copy_out_mode, linkable=linkable, manifest=manifest)
     else:
       if not os.path.exists(build_base):
         os.makedirs(build_base)
-      feed_to_rsync = audit.old_prereqs([key])
-      copy_out_cmd = ['rsync', '-a', '--files-from=-']
-
-    copy_out_cmd.extend([
-        '--delete',
-        '--delete-excluded',
-        '--exclude=*.swp',
-        '--exclude=' + os.path.basename(audit.dbfile),
-        base_dir + os.sep,
-        build_base])
-    run_with_stdin(copy_out_cmd, feed_to_rsync)
-
-  audit.setup(build_base)
+      out_copier = copy_files(base_dir, build_base, audit.old_prereqs([key]), excludes, delete=True,
+                              copier=opts.copier, label='Copy-out',
+                              mode=opts.copy_out_mode, linkable=linkable, manifest=manifest)
+    if manifest and opts.fresh and audit.has(key):
+      # A warm tree isn't recreated, so clear out what the last build
+      # made, lest the fresh audit take it for prereqs. The copy-out
+      # brought back any stale copies from the source tree too.
+      doomed = audit.old_targets([key])
+      clean_targets(build_base, doomed, prune=False)
+      manifest.forget(doomed)
+    if manifest:
+      manifest.save()
+
+  prefetcher = None
+  if opts.prefetch and audit.has(key):
+    prereqs = prefetch_order(audit.old_prereqs([key]), audit.old_stats([key]))
+    prefetcher = Prefetcher(build_base, prereqs).start()
+
+  audit.setup(build_base, scope or os.curdir)
 
   for cmd in opts.prebuild:
     verbose([cmd])
@@ -185,44 +364,189 @@ def main(argv):
     if (rc != 0):
       sys.exit(2)
 
-  rc = bldcmd.execute_in(bwd, start_time)
+  recoverable = external_base and not opts.fresh and opts.recover > 0
+  rc = bldcmd.execute_in(bwd, start_time, capture=recoverable)
+
+  if rc != 0 and recoverable:
+    # Incremental failures are usually a new input that was never
+    # copied out, so try fetching just that before going fresh.
+    first_start = bldcmd.build_start
+    for attempt in range(opts.recover):
+      fetched = fetch_missing(bldcmd.output, base_dir, build_base, bwd, audit.old_prereqs([key]),
+                              excludes, copier=opts.copier)
+      if not fetched:
+        break
+      # These predate the build as far as the audit is concerned.
+      audit.pre_existing.update(dict.fromkeys(fetched, True))
+      rc = bldcmd.execute_in(bwd, start_time, capture=True)
+      if rc == 0:
+        break
+    bldcmd.build_start = first_start
+
+  if prefetcher:
+    prefetcher.stop()
+
+  if out_copier and out_copier.linked:
+    # Hard-linked prereqs share storage with the source tree, so
+    # a build which modified one in place has modified the source.
+    damaged = out_copier.changed_links(base_dir)
+    if damaged:
+      for rpath in damaged:
+        print >> sys.stderr, "Error: build wrote through hard link to %s" % (os.path.join(base_dir, rpath))
+      sys.exit(2)
 
   if rc != 0 and external_base:
-    if opts.retry_in_place:
+    if opts.resume_in_place:
+      # Carry back what the external build finished, so the in-place
+      # make only has to redo what's left.
+      built = audit.modified(build_base)
+      if built:
+        copy_files(build_base, base_dir, built, copier=opts.copier, label='Copy-back')
+        fixup_files([os.path.join(base_dir, t) for t in built], external_base + os.sep, '/')
+      rc = bldcmd.execute_in(cwd, start_time)
+      sys.exit(rc)
+    elif opts.retry_in_place:
       rc = bldcmd.execute_in(cwd, start_time)
       sys.exit(rc)
     elif not opts.fresh:
       nargv = argv[:]
       nargv.insert(1, '--fresh')
       verbose(nargv)
+      if coordinator:
+        coordinator.release()
       rc = subprocess.call(nargv)
       sys.exit(rc)
 
-  if audit.noatime():
+  updated = False
+  if audit.noatime() and opts.mtime_only:
+    warnings.warn("build in noatime mount - recording targets by mtime only")
+    seconds = bldcmd.build_end - bldcmd.build_start
+    written = audit.update_mtime_only(key, build_base, str(datetime.timedelta(seconds=int(seconds))),
+                                      commit=rc == 0)
+    if external_base and written:
+      fixup = None
+      if opts.edit:
+        prefix = external_base + os.sep
+        fixup = lambda rpath: fixup_file(os.path.join(base_dir, rpath), prefix, '/')
+      copy_files(build_base, base_dir, written, ['*.tmp'], copier=opts.copier, label='Copy-in', on_copied=fixup)
+  elif audit.noatime():
     warnings.warn("audit skipped - build in noatime mount")
     if external_base:
-      copy_in_cmd = ['rsync', '-a', '--exclude=*.tmp', build_base + os.sep, base_dir]
-      run_with_stdin(copy_in_cmd, [])
+      sync_tree(build_base, base_dir, ['*.tmp'], copier=opts.copier, label='Copy-in')
   else:
     seconds = bldcmd.build_end - bldcmd.build_start
     bld_time = str(datetime.timedelta(seconds=int(seconds)))
     replace = opts.fresh and rc == 0
-    audit.update(key, build_base, bld_time, base_url, replace)
+    committer = None
+    previous_digests = audit.old_digests([key])
+    comment = {}
+    if fingerprint:
+      comment.update(FINGERPRINT=fingerprint, ENVIRONMENT=environment)
+    if scope:
+      comment['SCOPE'] = scope
+    updated = audit.update(key, build_base, bld_time, base_url, replace, commit=False,
+                           refresh=opts.avoid_build and rc == 0, digests=opts.digests or opts.verify,
+                           merge=opts.merge and rc == 0, max_age=opts.max_age,
+                           comment=comment or None)
+    if updated:
+      # The database can be written out while the targets go back.
+      if opts.detach_commit:
+        audit.commit_detached()
+      else:
+        committer = ThreadPool(1)
+        committed = committer.apply_async(audit.commit)
     if external_base:
-      if audit.new_targets:
-        copy_in_cmd = ['rsync', '-a', '--files-from=-', build_base + os.sep, base_dir]
-        run_with_stdin(copy_in_cmd, audit.new_targets)
+      copy_in = audit.new_targets
+      if copy_in and opts.skip_identical:
+        # Leaving identical targets alone keeps their timestamps,
+        # so the next in-place make sees nothing new downstream.
+        transform = None
+        if opts.edit:
+          prefix = external_base + os.sep
+          transform = lambda path: fixed_up(path, prefix, '/')
+        copy_in = changed_files(build_base, base_dir, audit.new_targets, hasher=audit.hashes, transform=transform)
+        verbose("Copy-in: %d of %d targets changed" % (len(copy_in), len(audit.new_targets)))
+      if copy_in:
+        fixup = None
         if opts.edit:
-          # TODO: better to write something like Perl's -T (text) test here
-          tgts = [os.path.join(base_dir, t) for t in audit.new_targets if re.search(r'\.(cmd|depend|d|flags)$', t)]
-          if tgts:
-            mldir = external_base + os.sep
-            for line in fileinput.input(tgts, inplace=True):
-              sys.stdout.write(line.replace(mldir, '/'))
-
-  if external_base and opts.remove_external_tree:
-    verbose("Removing %s/..." % (build_base))
-    shutil.rmtree(build_base)
+          prefix = external_base + os.sep
+          fixup = lambda rpath: fixup_file(os.path.join(base_dir, rpath), prefix, '/')
+        copy_files(build_base, base_dir, copy_in, copier=opts.copier, label='Copy-in', on_copied=fixup)
+        if manifest:
+          # Both copies are now identical, so don't copy them out again next time.
+          manifest.refresh(base_dir, copy_in)
+          manifest.save()
+    if committer:
+      committed.get()
+      committer.close()
+    if external_base and updated and audit.has(key) and audit.restat(key, base_dir, audit.new_targets):
+      # The targets left alone by --skip-identical, or fixed up by
+      # --edit, aren't as recorded in the external tree, and it's the
+      # source tree --avoid-build will check.
+      audit.wait_for_commit()
+      audit.commit()
+    if opts.verify and updated and rc == 0:
+      # Targets which come out different from the same inputs
+      # (timestamps, embedded paths and the like) defeat caching,
+      # so find them and record them as volatile.
+      volatile = None
+      if external_base:
+        targets = audit.old_targets([key])
+        verify_base = os.path.abspath(external_base + '.verify' + os.sep + base_dir)
+        try:
+          prepare_tree(build_base, verify_base, targets, excludes, copier=opts.copier)
+          vrc = 0
+          for cmd in opts.prebuild:
+            verbose([cmd])
+            vrc = subprocess.call(cmd, shell=True, cwd=verify_base, stdin=open(os.devnull))
+            if vrc != 0:
+              break
+          if vrc == 0:
+            first_build = bldcmd.build_start, bldcmd.build_end
+            vrc = bldcmd.execute_in(os.path.join(verify_base, os.path.relpath(bwd, build_base)), start_time)
+            bldcmd.build_start, bldcmd.build_end = first_build
+          if vrc == 0:
+            volatile = compare_trees(build_base, verify_base, targets)
+          else:
+            print >> sys.stderr, "Warning: verify rebuild of '%s' failed" % (key)
+        finally:
+          # A second whole tree is more than the cache budget allows for.
+          tree_cache.discard(verify_base)
+      else:
+        targets = audit.new_targets
+        volatile = compare_digests(previous_digests, audit.old_digests([key]), audit.old_prereqs([key]), targets)
+        if volatile is None:
+          verbose("Verify: no earlier build of '%s' from the same prereqs to compare with" % (key))
+      if volatile is not None:
+        report(key, volatile, len(targets))
+        audit.record_volatile(key, volatile)
+        audit.wait_for_commit()
+        audit.commit()
+    # Only a build whose prereqs were just audited (replaced, merged
+    # or refreshed) can vouch for its targets; a plain incremental
+    # build may have read inputs the key doesn't know of.
+    if artifacts and updated and audit.old_targets([key]):
+      digest = artifacts.digest(key, bldcmd.argv, base_dir, audit.old_prereqs([key]), fingerprint,
+                                audit.old_volatile(audit.all_keys()))
+      if digest:
+        artifacts.store(digest, base_dir, audit.old_targets([key]))
+    if updated and opts.parent_key:
+      with coordinator.exclusive():
+        parent = BuildAudit(opts.dbname) if opts.dbname else BuildAudit()
+        parent.merge_scope(opts.parent_key, scope, audit.db[key], key)
+        parent.commit()
+
+  if external_base:
+    if opts.remove_external_tree:
+      verbose("Removing %s/..." % (build_base))
+      tree_cache.remove(build_base)
+    else:
+      # The audit has just looked at every file in the tree, so
+      # there's no need to walk it again to find its size.
+      size = None
+      if updated and not scope:
+        size = sum(st[0] for st in audit.old_stats([key]).values())
+      tree_cache.release(build_base, opts.cache_budget, size)
 
   return rc
 
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import shared
+from auditutils import verbose
+
+CHUNK = 1024 * 1024
+
+PATH_RE = re.compile(r'^/(objects|entries)/([0-9a-f]{40})$')
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serve the RemoteCache protocol out of a directory.
+
+  Objects live under objects/ab/cdef... and entries under
+  entries/<digest>.json, the same layout as a local artifact
+  cache. Uploads are streamed to a temporary file and renamed
+  into place once complete, objects only if their contents
+  match their name.
+
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def locate(self):
+    match = PATH_RE.match(self.path)
+    if not match:
+      self.send_error(404)
+      return None, None
+    kind, digest = match.groups()
+    if kind == 'objects':
+      return kind, os.path.join(self.server.root, kind, digest[:2], digest[2:])
+    return kind, os.path.join(self.server.root, kind, digest + '.json')
+
+  def send_file(self, head):
+    kind, path = self.locate()
+    if not path:
+      return
+    try:
+      fp = open(path, 'rb')
+    except IOError:
+      self.send_error(404)
+      return
+    with fp:
+      self.send_response(200)
+      self.send_header('Content-Length', str(os.fstat(fp.fileno()).st_size))
+      self.send_header('Content-Type', 'application/json' if kind == 'entries' else 'application/octet-stream')
+      self.end_headers()
+      if not head:
+        shutil.copyfileobj(fp, self.wfile, CHUNK)
+
+  def do_GET(self):
+    self.send_file(False)
+
+  def do_HEAD(self):
+    self.send_file(True)
+
+  def do_PUT(self):
+    kind, path = self.locate()
+    if not path:
+      return
+    try:
+      length = int(self.headers.getheader('Content-Length'))
+    except (TypeError, ValueError):
+      self.send_error(411)
+      return
+    tmpdir = os.path.join(self.server.root, 'tmp')
+    fd, tmp = tempfile.mkstemp(dir=tmpdir)
+    try:
+      h = hashlib.sha1()
+      with os.fdopen(fd, 'wb') as fp:
+        while length > 0:
+          buf = self.rfile.read(min(length, CHUNK))
+          if not buf:
+            break
+          h.update(buf)
+          fp.write(buf)
+          length -= len(buf)
+      if length:
+        self.send_error(400, "Truncated upload")
+        return
+      if kind == 'objects':
+        if h.hexdigest() != os.path.basename(os.path.dirname(path)) + os.path.basename(path):
+          self.send_error(400, "Contents do not match digest")
+          return
+        os.chmod(tmp, 0o444)
+      else:
+        try:
+          json.load(open(tmp))
+        except ValueError:
+          self.send_error(400, "Entry is not JSON")
+          return
+        os.chmod(tmp, 0o644)
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      os.rename(tmp, path)
+      self.send_response(201)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def log_message(self, format, *args):
+    verbose("%s %s" % (self.address_string(), format % args))
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, root):
+    BaseHTTPServer.HTTPServer.__init__(self, address, CacheHandler)
+    self.root = root
+    for dir in ('objects', 'entries', 'tmp'):
+      if not os.path.isdir(os.path.join(root, dir)):
+        os.makedirs(os.path.join(root, dir))
+
+def main(argv):
+  """Serve a shared artifact cache over HTTP for AuditBuild --artifact-remote.
+
+  This is a reference implementation of the protocol, good for
+  trying things out on one machine or a small team. It keeps
+  everything it's given; prune the directory by other means.
+
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-a', '--address', default='',
+          help='Address to listen on (default all)')
+  parser.add_argument('-d', '--directory', default='.',
+          help='Directory to keep the cache in')
+  parser.add_argument('-P', '--port', type=int, default=8765,
+          help='Port to listen on')
+  parser.add_argument('-v', '--verbosity', type=int,
+          help='Change the amount of verbosity')
+  opts = parser.parse_args(argv[1:])
+
+  shared.verbosity = opts.verbosity if opts.verbosity is not None else 1
+
+  server = CacheServer((opts.address, opts.port), os.path.abspath(opts.directory))
+  verbose("Serving %s on port %d" % (server.root, server.server_address[1]))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if '__main__' == __name__:
+  sys.exit(main(sys.argv))
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import os
 import re
 import subprocess
 import sys
 
 import shared
-from auditutils import recreate_dir, verbose, dirnames, svn_export_files, svn_export_dirs
+from auditutils import recreate_dir, verbose, dirnames, format_bytes, parse_size, svn_export_files, svn_export_dirs
 from buildaudit import BuildAudit
+from warmtree import TreeCache
 
 def main(argv):
   """Read a build audit and dump the data in various formats."""
@@ -20,6 +22,10 @@ def main(argv):
           help='Print all involved files for key(s)')
   parser.add_argument('-b', '--build-time', action='store_true',
           help='Print the elapsed time of the specified build(s)')
+  parser.add_argument('--base-of-tree',
+          help='Path to root of the source tree, for --staleness')
+  parser.add_argument('--cache-budget', type=parse_size, default=os.getenv('AB_CACHE_BUDGET'),
+          help='Size budget to report external tree usage against')
   parser.add_argument('-D', '--dbname',
           help='Path to a database file')
   parser.add_argument('-d', '--print-directories', action='store_true',
@@ -36,16 +42,26 @@ def main(argv):
           help='List all known keys in the given database')
   parser.add_argument('-p', '--print-prerequisites', action='store_true',
           help='Print prerequisites for the given key(s)')
+  parser.add_argument('-S', '--staleness', action='store_true',
+          help='Print a JSON verdict per key on whether its prereqs still match the tree; exit 1 if any are stale')
   parser.add_argument('-s', '--print-sparse-file',
           help='Print a ".sparse" file covering the set of prereqs')
   parser.add_argument('-T', '--print-terminal-targets', action='store_true',
           help='Print terminal targets for the given key(s)')
   parser.add_argument('-t', '--print-targets', action='store_true',
           help='Print all targets for the given key(s)')
+  parser.add_argument('--top', type=int, metavar='N',
+          help='With --print-sizes, show only the N largest directories (default 20)')
   parser.add_argument('-u', '--print-unused', action='store_true',
           help='Print files present but unused for key(s)')
+  parser.add_argument('-V', '--print-volatile', action='store_true',
+          help='Print targets found by AuditBuild --verify to differ between identical builds')
+  parser.add_argument('-z', '--print-sizes', action='store_true',
+          help='Print per-directory file counts and sizes for each category, largest first')
   parser.add_argument('-v', '--verbosity', type=int,
           help='Change the amount of verbosity')
+  parser.add_argument('-x', '--external-tree-status', metavar='EXTERNAL_BASE',
+          help='Print size and last use of the external build trees under EXTERNAL_BASE')
   opts = parser.parse_args(argv[1:])
 
   if (len(argv) < 2):
@@ -58,6 +74,10 @@ def main(argv):
 
   rc = 0
 
+  if opts.external_tree_status:
+    TreeCache(os.path.abspath(opts.external_tree_status)).status(opts.cache_budget)
+    return rc
+
   if opts.dbname:
     audit = BuildAudit(opts.dbname)
   else:
@@ -84,7 +104,26 @@ def main(argv):
       if not keylist:
         sys.exit(2)
 
-  if opts.build_time:
+  if opts.staleness:
+    base_dir = os.path.abspath(opts.base_of_tree or '.')
+    for key in keylist:
+      verdict = audit.staleness(key, base_dir)
+      print json.dumps(verdict, sort_keys=True)
+      if verdict['stale']:
+        rc = 1
+  elif opts.print_sizes:
+    categories = ('PREREQS', 'INTERMEDIATES', 'TERMINALS', 'UNUSED')
+    rollup = audit.sizes_by_dir(keylist)
+    def total(dir):
+      return sum(nbytes for files, nbytes in rollup[dir].values())
+    grand = total(os.curdir) if rollup else 0
+    print "%10s %6s  %-18s %-18s %-18s %-18s  %s" % (('TOTAL', '%') + categories + ('DIRECTORY',))
+    for dir in sorted(rollup, key=lambda d: (-total(d), d))[:opts.top or 20]:
+      cells = ["%s/%d" % (format_bytes(rollup[dir].get(c, [0, 0])[1]), rollup[dir].get(c, [0, 0])[0])
+               for c in categories]
+      share = 100.0 * total(dir) / grand if grand else 0.0
+      print "%10s %5.1f%%  %-18s %-18s %-18s %-18s  %s" % tuple([format_bytes(total(dir)), share] + cells + [dir])
+  elif opts.build_time:
     for key in keylist:
       print "%s: %s" % (key, audit.bldtime(key))
   elif opts.print_sparse_file is not None:
@@ -118,6 +157,8 @@ def main(argv):
       results.update(audit.old_targets(keylist))
     if opts.print_unused:
       results.update(audit.old_unused(keylist))
+    if opts.print_volatile:
+      results.update(audit.old_volatile(keylist))
     for line in sorted(results):
       print line
 
@@ -7,15 +7,34 @@ ifneq (,$(filter AB_%,$(MAKEOVERRIDES)))
   ifeq (,$(MAKECMDGOALS))
     .DEFAULT_GOAL = all
   endif
+  # The first goal's rule builds them all in one audited build;
+  # the rules for the rest have nothing left to do.
+  _AuditFirstGoal := $(firstword $(MAKECMDGOALS) all)
   %:: $(MAKEFILE_LIST)
     ifeq (clean,$(findstring clean,$(MAKECMDGOALS)))
 	$(MAKE) $(_AuditMakeFlags) $(MAKECMDGOALS)
+    else ifdef AB_SCOPED
+	$(strip AuditMake -b $(BaseOfTree) $(if $(AB_DIR),-l $(AB_DIR)) $(AB_FLAGS) \
+		--scope $(if $(wildcard $@/.),$@,.) --parent-key '$(_AuditParentKey)' -- \
+		$(MAKE) $(_AuditMakeFlags) $(_AuditOverrides) $@)
     else
-	$(strip AuditMake -b $(BaseOfTree) $(if $(AB_DIR),-l $(AB_DIR)) $(AB_FLAGS) -- \
-		$(MAKE) $(_AuditMakeFlags) $(_AuditOverrides) $(MAKECMDGOALS))
+	$(if $(filter $@,$(_AuditFirstGoal)),$(strip AuditMake -b $(BaseOfTree) $(if $(AB_DIR),-l $(AB_DIR)) \
+		$(AB_FLAGS) -- $(MAKE) $(_AuditMakeFlags) $(_AuditOverrides) $(MAKECMDGOALS)),@:)
     endif
   $(MAKEFILE_LIST): ;
-  .NOTPARALLEL:
+  ifdef AB_SCOPED
+    # Each goal naming a subdirectory gets its own audit scoped to
+    # it, so they can run in parallel; any other goal is audited
+    # over the whole tree. The key the whole command line would
+    # have had collects the results of all of them.
+    _AuditEmpty :=
+    _AuditSpace := $(_AuditEmpty) $(_AuditEmpty)
+    _AuditKeyOverrides := $(sort $(filter-out JOBS=% PAR=% V=% VERBOSE=%,$(_AuditOverrides)))
+    _AuditKeyGoals := $(subst $(_AuditSpace),:,$(sort $(or $(MAKECMDGOALS),all)))
+    _AuditParentKey := $(if $(_AuditKeyOverrides),$(subst $(_AuditSpace),__,$(_AuditKeyOverrides));)$(_AuditKeyGoals)
+  else
+    .NOTPARALLEL:
+  endif
 else    	#AB_%
   MAKEFILE_LIST :=
   include $(Makefile)
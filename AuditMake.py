@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import os
+import sys
+
+# AuditBuild options which take a value; everything else is a flag.
+# This and the tables below must be kept in step with AuditBuild.py
+# and GMakeCommand respectively.
+VALUE_OPTS = frozenset(['--artifact-budget', '--artifact-cache', '--artifact-mode', '--artifact-remote', '-b',
+                        '--base-of-tree', '--cache-budget', '--copier', '--copy-out-mode', '-D', '--dbname', '-E',
+                        '--extract-dirs-with-fallback', '--fingerprint-tools', '--fingerprint-vars', '-k', '--key',
+                        '--max-age', '-p', '--parent-key', '--prebuild', '--recover', '--scope', '-U', '--base-url',
+                        '-v', '--verbosity', '-x', '--external-base'])
+FLAG_OPTS = frozenset(['--avoid-build', '-c', '--clean', '--clean-all-keys', '--clean-dry-run', '--detach-commit',
+                       '--digests', '-e', '--edit', '-f', '--fingerprint', '--fresh', '--merge', '--mtime-only',
+                       '--prefetch', '-R', '--remove-external-tree', '-r', '--retry-in-place', '--resume-in-place',
+                       '-S', '--skip-identical', '--verify', '-W', '--warm', '-X', '--execute-only'])
+
+DEFAULT_PREBUILD = 'test ! -d src/include || REUSE_VERSION=1 make -C src/include'
+
+# Make flags which mark a build as a special case, not worth auditing.
+SPECIAL_SHORT = 'BeIikLnopqRrStvW'
+SPECIAL_LONG = frozenset(['always-make', 'environment-overrides', 'include-dir', 'ignore-errors', 'keep-going',
+                          'check-symlink-times', 'dry-run', 'old-file', 'print-data-base', 'question',
+                          'no-builtin-variables', 'no-builtin-rules', 'no-keep-going', 'touch', 'version',
+                          'what-if'])
+# Short make flags whose value may be the following word.
+VALUE_SHORT = 'fjlCIoW'
+# The other make flags GMakeCommand knows, none of them special.
+PLAIN_SHORT = 'Cfjlsw'
+PLAIN_LONG = frozenset(['directory', 'file', 'jobs', 'load-average', 'no-print-directory', 'print-directory',
+                        'silent', 'warn-undefined-variables'])
+VALUE_LONG = frozenset(['directory', 'file', 'jobs', 'load-average'])
+
+def parse_auditbuild(args):
+  """Split AuditBuild args into (options, build command), or return None if unsure."""
+  opts = {}
+  i = 0
+  while i < len(args):
+    arg = args[i]
+    if arg == '--':
+      return opts, args[i + 1:]
+    if not arg.startswith('-') or arg == '-':
+      return opts, args[i:]
+    if arg.startswith('--') and '=' in arg:
+      name, value = arg.split('=', 1)
+      if name not in VALUE_OPTS:
+        return None
+      opts.setdefault(name, []).append(value)
+    elif arg in VALUE_OPTS:
+      if i + 1 == len(args):
+        return None
+      i += 1
+      opts.setdefault(arg, []).append(args[i])
+    elif arg in FLAG_OPTS:
+      opts[arg] = True
+    elif not arg.startswith('--') and arg[:2] in VALUE_OPTS:
+      opts.setdefault(arg[:2], []).append(arg[2:])
+    else:
+      return None
+    i += 1
+  return None
+
+def make_is_special(argv):
+  """Tell, as GMakeCommand would, whether a make command line is a special case.
+
+  Returns None on meeting a flag GMakeCommand doesn't know (e.g.
+  -O, which takes an optional value), leaving it to decide.
+
+  """
+  words = argv[1:]
+  i = 0
+  while i < len(words):
+    word = words[i]
+    i += 1
+    # A bare -j takes no value unless a number follows.
+    bare = word in ('-j', '--jobs') and not (i < len(words) and words[i].isdigit())
+    if word.startswith('--'):
+      name = word[2:].split('=')[0]
+      if name in SPECIAL_LONG:
+        return True
+      if name not in PLAIN_LONG:
+        return None
+      if name in VALUE_LONG and '=' not in word and not bare:
+        i += 1
+    elif word.startswith('-') and '=' not in word:
+      for pos, letter in enumerate(word[1:]):
+        if letter in SPECIAL_SHORT:
+          return True
+        if letter not in PLAIN_SHORT:
+          return None
+        if letter == 'C' and pos < len(word) - 2:
+          return None  # GMakeCommand loses the attached value and takes the next word
+        if letter in VALUE_SHORT:
+          if pos == len(word) - 2 and not bare:
+            i += 1
+          break
+  return False
+
+def makeflags_letters():
+  import re
+  makeflags = os.getenv('MAKEFLAGS', '')
+  makeflags = re.sub(r'\s+--\s+.*', '', makeflags)
+  makeflags = re.sub(r'\s*--\S+', '', makeflags)
+  makeflags = re.sub(r'\S+=\S+', '', makeflags)
+  return makeflags
+
+def run_prebuilds(opts):
+  """Run the prebuild commands where AuditBuild would have run them."""
+  import subprocess
+  base_dir = os.path.abspath((opts.get('-b') or opts.get('--base-of-tree') or ['.'])[-1])
+  xd = (opts.get('-x') or opts.get('--external-base') or [os.getenv('AB_EXTERNAL_BASE')])[-1]
+  build_base = os.path.abspath(xd + os.sep + base_dir) if xd is not None else base_dir
+  for cmd in [DEFAULT_PREBUILD] + opts.get('-p', []) + opts.get('--prebuild', []):
+    if subprocess.call(cmd, shell=True, cwd=build_base, stdin=open(os.devnull)) != 0:
+      sys.exit(2)
+
+def exec_build(cmd):
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os.execvp(cmd[0], cmd)
+
+def main(argv):
+  """Start an audited build, or get out of the way if there's nothing to audit.
+
+  This takes the same arguments as AuditBuild. Before paying
+  for the full auditor's imports and command parsing, it looks
+  for the cases where no audit will happen and replaces itself
+  with the build command directly:
+
+   - a nested invocation, i.e. a recursive make within a build
+     which is already being audited (AB_AUDIT_ACTIVE is set);
+   - a dry run, which AuditBuild skips altogether;
+   - --execute-only, or a make command line which GMakeCommand
+     would consider a special case. As with AuditBuild, the
+     prebuild commands are run first.
+
+  Anything else, or anything it doesn't recognize, is passed
+  on to AuditBuild unchanged.
+
+  """
+  parsed = parse_auditbuild(argv[1:])
+  if parsed and parsed[1] and not (parsed[0].get('-E') or parsed[0].get('--extract-dirs-with-fallback')):
+    opts, cmd = parsed
+    if os.getenv('AB_AUDIT_ACTIVE'):
+      exec_build(cmd)
+    makeflags = makeflags_letters()
+    if 'n' in makeflags:
+      return 0
+    if (opts.get('-X') or opts.get('--execute-only') or make_is_special(cmd)
+        or [c for c in makeflags if c in SPECIAL_SHORT]):
+      run_prebuilds(opts)
+      exec_build(cmd)
+
+  import AuditBuild
+  return AuditBuild.main(argv)
+
+if '__main__' == __name__:
+  sys.exit(main(sys.argv))
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,256 @@
+import collections
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+from auditutils import file_digest, file_lock, format_bytes, parallel_map, verbose, write_json
+from treecopy import TreeCopier
+
+# In place of [digest, mode], an entry records a symlink target as [SYMLINK, its text].
+SYMLINK = 'symlink'
+
+class ArtifactCache(object):
+  """A content-addressed store of build targets, shared by any number of trees.
+
+  An entry is keyed by a digest over the audit key, the build
+  command, the environment fingerprint if there is one and the
+  contents of every prereq recorded for the key;
+  it maps each target's path to the digest of its contents, and
+  the contents themselves are kept once under objects/. A hit
+  puts the targets in place (by copy, reflink or hard link) in
+  place of a build. Each entry's mtime records when it was last
+  used, and when the store outgrows its budget the least recently
+  used entries go, along with any objects no entry refers to.
+  Stores and eviction take an exclusive lock, fetches a shared
+  one, and every file appears by rename, so concurrent builds
+  see either all of an entry or none of it. Given a RemoteCache,
+  a local miss is tried there before giving up, and new entries
+  are pushed to it.
+
+  Objects are kept read-only. Hard-linked targets share an inode
+  with the store, so in hardlink mode targets are recorded and
+  put in place read-only too; ld and the like replace rather
+  than rewrite their outputs, so a later build still works.
+  Read-only doesn't stop root, so a root build gets copies.
+  Targets which are symlinks are recorded by their text alone.
+
+  """
+  def __init__(self, root, budget=None, mode='copy', jobs=None, hasher=None, remote=None):
+    self.root = root
+    self.remote = remote
+    self.digest_file = hasher.digest if hasher else lambda path, st=None: file_digest(path)
+    self.budget = budget
+    self.mode = mode
+    self.jobs = jobs
+    self.objects = os.path.join(root, 'objects')
+    self.entries = os.path.join(root, 'entries')
+    self.tmp = os.path.join(root, 'tmp')
+    for dir in (self.objects, self.entries, self.tmp):
+      try:
+        os.makedirs(dir)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def locked(self, how=fcntl.LOCK_EX):
+    return file_lock(os.path.join(self.root, '.lock'), how)
+
+  def digest(self, key, command, basedir, prereqs, fingerprint=None, volatile=()):
+    """Return the entry digest for key given the prereqs as they are in basedir, or None."""
+    rpaths = sorted(prereqs)
+    def content(rpath):
+      try:
+        if rpath in volatile:
+          return 'volatile:%d' % (os.path.getsize(os.path.join(basedir, rpath)))
+        return self.digest_file(os.path.join(basedir, rpath))
+      except (IOError, OSError):
+        return None
+    contents = parallel_map(content, rpaths, self.jobs)
+    if None in contents:
+      return None
+    h = hashlib.sha1()
+    h.update(json.dumps([key, command] + ([fingerprint] if fingerprint else []) + [zip(rpaths, contents)]))
+    return h.hexdigest()
+
+  def object_path(self, digest):
+    return os.path.join(self.objects, digest[:2], digest[2:])
+
+  def entry_path(self, digest):
+    return os.path.join(self.entries, digest + '.json')
+
+  def fetch(self, digest, dstdir):
+    """Put the targets of an entry in place under dstdir; return them, or None on a miss."""
+    if self.remote and not os.path.exists(self.entry_path(digest)):
+      self.pull(digest)
+    with self.locked(fcntl.LOCK_SH):
+      try:
+        entry = json.load(open(self.entry_path(digest)))
+      except (IOError, ValueError):
+        return None
+      copier = TreeCopier(jobs=self.jobs, mode=self.mode, linkable=entry)
+      hardlink = self.mode == 'hardlink' and os.geteuid() != 0
+      def place(rpath):
+        digest, mode = entry[rpath]
+        dst = os.path.join(dstdir, rpath)
+        copier.makedirs(os.path.dirname(dst))
+        try:
+          os.remove(dst)
+        except OSError as e:
+          if e.errno != errno.ENOENT:
+            raise
+        if digest == SYMLINK:
+          os.symlink(mode, dst)
+          return
+        obj = self.object_path(digest)
+        st = os.lstat(obj)
+        if not (hardlink and stat.S_IMODE(st.st_mode) == mode and copier.share_data(obj, dst, rpath, st)):
+          if not (self.mode == 'reflink' and copier.share_data(obj, dst, rpath, st)):
+            copier.copy_data(obj, dst, st)
+          os.chmod(dst, mode)
+        # Newer than the prereqs, as if just built.
+        os.utime(dst, None)
+      # Symlinks go in last, so no file is put in place through one.
+      links = set(rp for rp in entry if entry[rp][0] == SYMLINK)
+      parallel_map(place, sorted(set(entry) - links), self.jobs)
+      parallel_map(place, sorted(links), self.jobs)
+      os.utime(self.entry_path(digest), None)
+    verbose("Artifact cache hit: %d targets from %s" % (len(entry), digest[:12]))
+    return sorted(entry)
+
+  def store(self, digest, srcdir, targets):
+    """Add the targets as they are in srcdir under digest; return False if any are missing."""
+    rpaths = sorted(targets)
+    copier = TreeCopier(jobs=self.jobs, mode='reflink' if self.mode != 'copy' else 'copy')
+    def add(rpath):
+      src = os.path.join(srcdir, rpath)
+      st = os.lstat(src)
+      if stat.S_ISLNK(st.st_mode):
+        return [SYMLINK, os.readlink(src)]
+      if not stat.S_ISREG(st.st_mode):
+        raise OSError(errno.EINVAL, "not a regular file", src)
+      content = self.digest_file(src, st)
+      obj = self.object_path(content)
+      if not os.path.exists(obj):
+        copier.makedirs(os.path.dirname(obj))
+        fd, tmp = tempfile.mkstemp(dir=self.tmp)
+        os.close(fd)
+        os.remove(tmp)
+        if not copier.share_data(src, tmp, rpath, st):
+          copier.copy_data(src, tmp, st)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode) & ~0o222)
+        os.rename(tmp, obj)
+      mode = stat.S_IMODE(st.st_mode)
+      return [content, mode & ~0o222 if self.mode == 'hardlink' else mode]
+    with self.locked():
+      try:
+        entry = dict(zip(rpaths, parallel_map(add, rpaths, self.jobs)))
+      except (IOError, OSError) as e:
+        verbose("Not caching artifacts: %s: %s" % (e.filename, e.strerror))
+        return False
+      self.write_entry(digest, entry)
+      verbose("Artifact cache: stored %d targets as %s" % (len(entry), digest[:12]))
+      if self.budget is not None:
+        self.evict(self.budget, keep=digest)
+    if self.remote:
+      self.push(digest, entry)
+    return True
+
+  def pull(self, digest):
+    """Copy an entry and whichever of its objects are missing here from the remote cache."""
+    entry = self.remote.get_entry(digest)
+    if entry is None:
+      return False
+    missing = sorted(c for c in self.contents(entry) if not os.path.exists(self.object_path(c)))
+    def download(content):
+      fd, tmp = tempfile.mkstemp(dir=self.tmp)
+      os.close(fd)
+      if self.remote.get_object(content, tmp):
+        os.chmod(tmp, 0o444)
+        return tmp
+      os.remove(tmp)
+      return None
+    tmps = parallel_map(download, missing, self.jobs)
+    with self.locked():
+      if None not in tmps:
+        for content, tmp in zip(missing, tmps):
+          path = self.object_path(content)
+          if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+          os.rename(tmp, path)
+        self.write_entry(digest, entry)
+    for tmp in tmps:
+      if tmp and os.path.exists(tmp):
+        os.remove(tmp)
+    if None in tmps:
+      return False
+    verbose("Artifact cache: fetched %d of %d objects for %s from remote" % (len(missing),
+            len(self.contents(entry)), digest[:12]))
+    return True
+
+  def push(self, digest, entry):
+    """Upload an entry and whichever of its objects the remote cache lacks."""
+    contents = sorted(self.contents(entry))
+    def upload(content):
+      if self.remote.has_object(content):
+        return True
+      try:
+        return self.remote.put_object(content, self.object_path(content))
+      except (IOError, OSError):
+        return False  # evicted here meanwhile
+    # The entry goes last, so no one sees it before its objects.
+    if all(parallel_map(upload, contents, self.jobs)) and self.remote.put_entry(digest, entry):
+      verbose("Artifact cache: pushed %s to remote" % (digest[:12]))
+
+  def write_entry(self, digest, entry):
+    write_json(self.entry_path(digest), entry, indent=2, sort_keys=True, tmpdir=self.tmp)
+
+  @staticmethod
+  def contents(entry):
+    return set(content for content, mode in entry.values() if content != SYMLINK)
+
+  def evict(self, budget, keep=None):
+    """Drop least recently used entries, other than keep, until the objects fit the budget.
+
+    Call with the lock held.
+
+    """
+    sizes = {}
+    for parent, dir_names, file_names in os.walk(self.objects):
+      for fn in file_names:
+        sizes[os.path.basename(parent) + fn] = os.lstat(os.path.join(parent, fn)).st_blocks * 512
+    entries = []
+    for fn in os.listdir(self.entries):
+      path = os.path.join(self.entries, fn)
+      if path == self.entry_path(keep or ''):
+        continue
+      try:
+        entries.append((os.path.getmtime(path), path, json.load(open(path))))
+      except (IOError, OSError, ValueError):
+        continue
+    entries.sort()
+    refs = collections.Counter(content for mtime, path, entry in entries for content in self.contents(entry))
+    if keep:
+      refs.update(self.contents(json.load(open(self.entry_path(keep)))))
+    # Objects from an interrupted store belong to no entry.
+    for content in [c for c in sizes if not refs[c]]:
+      os.remove(self.object_path(content))
+      del sizes[content]
+    total = sum(sizes.values())
+    evicted = 0
+    while total > budget and entries:
+      mtime, path, entry = entries.pop(0)
+      os.remove(path)
+      evicted += 1
+      for content in self.contents(entry):
+        refs[content] -= 1
+        if refs[content] == 0 and content in sizes:
+          os.remove(self.object_path(content))
+          total -= sizes.pop(content)
+    if evicted:
+      verbose("Artifact cache: evicted %d entries, %s left" % (evicted, format_bytes(total)))
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -1,9 +1,32 @@
 import shared
+import contextlib
+import ctypes
+import errno
+import fcntl
+import hashlib
+import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
-import xml.dom.minidom
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+def libc_function(names, restype, argtypes):
+  """Look up the first of names in the C library, for calls this Python's os lacks."""
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+  except OSError:
+    return None
+  for name in names:
+    func = getattr(libc, name, None)
+    if func is not None:
+      func.restype = restype
+      func.argtypes = argtypes
+      return func
+  return None
 
 def verbose(message):
   """Print optional verbosity."""
@@ -35,6 +58,7 @@ def getText(nodelist):
   return ''.join(txt)
 
 def svn_get_url(dir):
+  import xml.dom.minidom
   cmd = ['svn', 'info', '--xml']
   subproc = subprocess.Popen(cmd, cwd=dir, stdout=subprocess.PIPE, stderr=open(os.devnull))
   output = subproc.communicate()
@@ -92,4 +116,157 @@ def run_with_stdin(cmd, input):
   if subproc.wait():
     sys.exit(2)
 
+def default_jobs():
+  """Return the number of worker threads to use for parallel phases.
+
+  This follows make's -j where one was given, and drops to one
+  thread while the load average is over make's -l limit.
+
+  """
+  load = getattr(shared, 'load_average', None)
+  if load:
+    try:
+      if os.getloadavg()[0] >= load:
+        return 1
+    except OSError:
+      pass
+  jobs = getattr(shared, 'jobs', None)
+  if not jobs:
+    try:
+      jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+      jobs = 1
+  return jobs
+
+def parallel_map(func, items, jobs=None, slotted=True):
+  """Apply func to each item using a pool of threads, preserving order.
+
+  Most of what the parallel phases do is filesystem I/O, which
+  releases the interpreter lock, so threads are sufficient here.
+  Under a make jobserver each item is processed holding a job
+  slot, so the pool never runs more than make allows, unless
+  slotted is false, as for work running alongside make itself.
+
+  """
+  items = list(items)
+  if jobs is None:
+    jobs = default_jobs()
+  if jobs <= 1 or len(items) <= 1:
+    return [func(item) for item in items]
+  server = slotted and getattr(shared, 'jobserver', None)
+  if server:
+    unslotted = func
+    def func(item):
+      token = server.acquire()
+      try:
+        return unslotted(item)
+      finally:
+        server.release(token)
+  pool = ThreadPool(min(jobs, len(items)))
+  try:
+    return pool.map(func, items)
+  finally:
+    pool.close()
+    pool.join()
+
+def file_digest(path, chunk=1024 * 1024):
+  """Return the SHA-1 hex digest of a file's contents."""
+  h = hashlib.sha1()
+  with open(path, 'rb') as fp:
+    while True:
+      buf = fp.read(chunk)
+      if not buf:
+        break
+      h.update(buf)
+  return h.hexdigest()
+
+def mtime_ns(st):
+  """Return a stat result's mtime as integer nanoseconds."""
+  try:
+    return st.st_mtime_ns
+  except AttributeError:
+    return int(round(st.st_mtime * 1e9))
+
+def parse_size(text):
+  """Parse a size such as '512M' or '20G' into bytes."""
+  units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+  text = text.strip().upper().rstrip('B').rstrip('I')
+  suffix = text[-1:] if text[-1:] in units else ''
+  return int(float(text[:len(text) - len(suffix)]) * units[suffix])
+
+def atime_ns(st):
+  """Return a stat result's atime as integer nanoseconds."""
+  try:
+    return st.st_atime_ns
+  except AttributeError:
+    return int(round(st.st_atime * 1e9))
+
+def ctime_ns(st):
+  """Return a stat result's ctime as integer nanoseconds."""
+  try:
+    return st.st_ctime_ns
+  except AttributeError:
+    return int(round(st.st_ctime * 1e9))
+
+def format_bytes(nbytes):
+  """Render a byte count in human-readable binary units."""
+  units = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+  size = float(nbytes)
+  while size >= 1024 and len(units) > 1:
+    size /= 1024
+    units.pop(0)
+  return "%.1f %s" % (size, units[0])
+
+def pid_alive(pid):
+  """Tell whether a process exists, whoever it belongs to."""
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+@contextlib.contextmanager
+def file_lock(path, how=fcntl.LOCK_EX):
+  """Hold a flock on path, creating it (and its directory) if need be."""
+  try:
+    os.makedirs(os.path.dirname(os.path.abspath(path)))
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  with open(path, 'a') as lock:
+    fcntl.flock(lock.fileno(), how)
+    yield
+
+def load_json(path):
+  """Return the JSON data in path, or {} if it's missing or unreadable."""
+  try:
+    return json.load(open(path))
+  except (IOError, ValueError):
+    return {}
+
+def write_json(path, data, indent=None, sort_keys=False, tmpdir=None):
+  """Write data to path as JSON, atomically replacing any previous version.
+
+  The data goes to a temporary file, in tmpdir if given or else
+  beside path, which is then renamed over it, so readers see the
+  old contents or the new but never part of either.
+
+  """
+  parent, name = os.path.split(os.path.abspath(path))
+  fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', dir=tmpdir or parent)
+  with os.fdopen(fd, 'w') as fp:
+    json.dump(data, fp, indent=indent, sort_keys=sort_keys)
+    if indent is not None:
+      fp.write('\n')  # json does not add trailing newline
+  os.chmod(tmp, 0o644)
+  os.rename(tmp, path)
+
+def update_json(path, update):
+  """Run update(data) on a JSON registry under its lock, write it back and return update's result."""
+  with file_lock(path + '.lock'):
+    data = load_json(path)
+    result = update(data)
+    write_json(path, data, indent=2, sort_keys=True)
+  return result
+
 # vim: ts=8:sw=2:tw=120:et:
@@ -3,11 +3,24 @@ import json
 import os
 import re
 import sys
-import tempfile
+import threading
 import time
 import warnings
 
-from auditutils import verbose
+from auditutils import atime_ns, mtime_ns, parallel_map, pid_alive, verbose, write_json
+from hashcache import HashCache
+from scopes import is_registry
+
+# Copies made through float timestamps (Python 2's utime() goes by
+# way of utimes()) keep an mtime truncated to the microsecond, and
+# the doubles stat() returns either side are each a few hundred ns
+# out at present-day times, so a faithful copy can be out by more
+# than a microsecond but never by two.
+MTIME_SLOP_NS = 2000
+
+def mtime_matches(st, recorded_ns):
+  """Tell whether a stat result's mtime is the one recorded, to within what copying it can lose."""
+  return abs(mtime_ns(st) - recorded_ns) < MTIME_SLOP_NS
 
 class BuildAudit:
   """Class to manage and persist the audit of a build into prereqs and targets.
@@ -20,12 +33,18 @@ class BuildAudit:
   these file sets.
 
   """
+  ref_file = '.audit-ref.tmp'
+
   def __init__(self, dbname='BuildAudit.json', dbdir=None):
     if dbdir:
       self.dbfile = os.path.join(dbdir, dbname)
     else:
       self.dbfile = dbname
 
+    self.pending = self.dbfile + '.pending'
+    self.hashes = HashCache(self.dbfile + '.hashes')
+    self.wait_for_commit()
+
     try:
       self.db = json.load(open(self.dbfile))
     except IOError:
@@ -33,6 +52,54 @@ class BuildAudit:
 
     self.new_targets = {}
 
+  def wait_for_commit(self):
+    """Wait for a detached commit of this database, if one is in progress."""
+    while True:
+      try:
+        pid = int(open(self.pending).read())
+      except (IOError, ValueError):
+        return
+      if not pid_alive(pid):
+        # The committer died; the database file is still intact
+        # since commits replace it atomically.
+        try:
+          os.remove(self.pending)
+        except OSError:
+          pass
+        return
+      time.sleep(0.1)
+
+  def commit(self):
+    """Write the database, atomically replacing the previous version."""
+    write_json(os.path.abspath(self.dbfile), self.db, indent=2)
+
+  def commit_detached(self):
+    """Commit from a background process so the caller needn't wait.
+
+    A marker file holding the committer's pid exists for as long
+    as the commit is in progress; any later BuildAudit for the
+    same database waits for it to go away before reading.
+
+    """
+    with open(self.pending, "w") as fp:
+      pid = os.fork()
+      if pid:
+        fp.write(str(pid))
+        return
+    try:
+      devnull = os.open(os.devnull, os.O_RDWR)
+      for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+      # Don't start until the parent has published our pid.
+      while os.path.getsize(self.pending) == 0:
+        time.sleep(0.01)
+      self.commit()
+    finally:
+      try:
+        os.remove(self.pending)
+      finally:
+        os._exit(0)
+
   def has(self, key):
     return key in self.db
 
@@ -58,19 +125,257 @@ class BuildAudit:
   def old_unused(self, keys):
     return self.old_data(keys, 'UNUSED')
 
+  def old_stats(self, keys):
+    """Return {path: [size, mtime_ns, atime_ns]} as recorded at the end of the build(s)."""
+    results = {}
+    for key in keys:
+      if key in self.db:
+        results.update(self.db[key].get('STATS', {}))
+    return results
+
+  def restat(self, key, basedir, rpaths):
+    """Re-record the STATS of key for those of rpaths as they now are in basedir; return True if any changed."""
+    stats = self.db[key].setdefault('STATS', {})
+    changed = False
+    for rpath in rpaths:
+      if rpath not in stats:
+        continue
+      try:
+        st = os.lstat(os.path.join(basedir, rpath))
+      except OSError:
+        continue
+      # A copy alone can move the mtime slightly, so that's no change.
+      if st.st_size != stats[rpath][0] or not mtime_matches(st, stats[rpath][1]):
+        stats[rpath] = [st.st_size, mtime_ns(st), atime_ns(st)]
+        changed = True
+    return changed
+
+  def linkable_prereqs(self, key):
+    """Return the prereqs of key which no audit has seen written, so may be hard-linked.
+
+    A prereq is left out if any key records it as a target, or
+    if its recorded mtime isn't older than the start of the build,
+    as happens with builds which rewrite their own inputs.
+
+    """
+    if key not in self.db:
+      return {}
+    try:
+      reftime_ns = float(self.db[key]['COMMENT']['REFTIME'].split()[0]) * 1e9
+    except (KeyError, ValueError, IndexError):
+      return {}
+    stats = self.old_stats([key])
+    targets = self.old_targets(self.all_keys())
+    return dict((rp, v) for rp, v in self.old_prereqs([key]).items()
+                if rp not in targets and rp in stats and stats[rp][1] < reftime_ns)
+
+  def old_digests(self, keys):
+    """Return {path: sha1} for the prereqs and targets, if digests were recorded."""
+    return self.old_data([k for k in keys if 'DIGESTS' in self.db.get(k, {})], 'DIGESTS')
+
+  def old_volatile(self, keys):
+    """Return {path: offset} for the targets found to differ between identical builds."""
+    return self.old_data([k for k in keys if 'VOLATILE' in self.db.get(k, {})], 'VOLATILE')
+
+  def record_volatile(self, key, volatile):
+    """Add to the targets of key known to differ between builds from the same prereqs.
+
+    Targets marked before stay marked as long as they're still
+    targets of key, since a rebuild may happen to match by chance
+    (e.g. an embedded timestamp within the same second).
+
+    """
+    entry = self.db[key]
+    targets = self.old_targets([key])
+    known = dict((rp, off) for rp, off in entry.get('VOLATILE', {}).items() if rp in targets)
+    known.update(volatile)
+    entry['VOLATILE'] = known
+
+  def avoidable(self, key, basedir, builddir=None, jobs=None):
+    """Tell whether the recorded build of key still stands, so needn't be redone.
+
+    Every prereq and terminal target in basedir is checked against
+    the size and mtime recorded at the end of the build; a file
+    whose timestamp moved but whose size and digest (if recorded)
+    are unchanged still counts as unchanged. Returns None when
+    anything differs, else the list of terminal targets missing
+    from basedir but intact in builddir, which can be restored
+    from there rather than rebuilt. Checking stops at the first
+    difference.
+
+    """
+    stats = self.old_stats([key])
+    digests = self.old_digests([key])
+    prereqs = self.old_prereqs([key])
+    terminals = self.old_terminals([key])
+    changed = threading.Event()
+
+    def intact(dir, rpath):
+      recorded = stats.get(rpath)
+      if not recorded:
+        return False
+      try:
+        st = os.lstat(os.path.join(dir, rpath))
+      except OSError:
+        return None
+      if st.st_size != recorded[0]:
+        return False
+      if mtime_matches(st, recorded[1]):
+        return True
+      return rpath in digests and self.hashes.digest(os.path.join(dir, rpath)) == digests[rpath]
+
+    def check(rpath):
+      if changed.is_set():
+        return None
+      state = intact(basedir, rpath)
+      if state is None and rpath in terminals and builddir and builddir != basedir:
+        if intact(builddir, rpath):
+          return 'restore'
+        state = False
+      if not state and not changed.is_set():
+        changed.set()
+        verbose("Build of '%s' needed: %s %s" % (key, rpath, 'is missing' if state is None else 'has changed'))
+      return state
+
+    rpaths = sorted(prereqs) + sorted(terminals)
+    results = parallel_map(check, rpaths, jobs)
+    if not rpaths or changed.is_set():
+      return None
+    return [rp for rp, state in zip(rpaths, results) if state == 'restore']
+
+  def staleness(self, key, basedir, jobs=None):
+    """Tell whether the prereq set recorded for key still describes basedir.
+
+    Each prereq is lstat-ed and compared with the size and mtime
+    recorded at the end of the build, and each directory holding
+    a prereq is listed for files which weren't there then. No file
+    is read. Checking stops at the first mismatch. Returns a
+    verdict as a dict: 'stale' is False if nothing was found,
+    otherwise 'reason' is one of 'unrecorded', 'deleted',
+    'modified' or 'added' and 'path' names the file concerned.
+
+    """
+    stats = self.old_stats([key])
+    prereqs = self.old_prereqs([key])
+    verdict = {'key': key, 'stale': False, 'reason': None, 'path': None, 'checked': len(prereqs)}
+    if not stats or not prereqs:
+      verdict.update(stale=True, reason='unrecorded')
+      return verdict
+    # The database's own files come and go independently.
+    ours = os.path.basename(self.dbfile)
+    known = {}
+    for rpath in stats:
+      known.setdefault(os.path.dirname(rpath), set()).add(os.path.basename(rpath))
+    found = threading.Event()
+    lock = threading.Lock()
+
+    def mismatch(reason, rpath):
+      with lock:
+        if not found.is_set():
+          found.set()
+          verdict.update(stale=True, reason=reason, path=rpath)
+
+    def check_file(rpath):
+      if found.is_set():
+        return
+      recorded = stats.get(rpath)
+      try:
+        st = os.lstat(os.path.join(basedir, rpath))
+      except OSError:
+        return mismatch('deleted', rpath)
+      if not recorded or st.st_size != recorded[0] or not mtime_matches(st, recorded[1]):
+        mismatch('modified', rpath)
+
+    def check_dir(dir):
+      if found.is_set():
+        return
+      try:
+        names = os.listdir(os.path.join(basedir, dir))
+      except OSError:
+        return  # its prereqs will show up as deleted
+      for name in names:
+        if name in known.get(dir, ()) or self.ignored(name) or name.startswith(ours) or name.startswith('.svn'):
+          continue
+        if not os.path.isdir(os.path.join(basedir, dir, name)):
+          return mismatch('added', os.path.join(dir, name))
+
+    parallel_map(check_file, sorted(prereqs), jobs)
+    if not found.is_set():
+      parallel_map(check_dir, sorted(set(os.path.dirname(rp) for rp in prereqs)), jobs)
+    return verdict
+
+  def sizes_by_dir(self, keys):
+    """Roll up the recorded file counts and sizes per directory and category.
+
+    Returns {dir: {category: [files, bytes]}}, where a directory's
+    figures include everything beneath it and '.' stands for the
+    whole tree. Sizes come from the recorded STATS, so nothing is
+    read from the filesystem.
+
+    """
+    stats = self.old_stats(keys)
+    rollup = {}
+    for category in ('PREREQS', 'INTERMEDIATES', 'TERMINALS', 'UNUSED'):
+      for rpath in self.old_data(keys, category):
+        size = stats.get(rpath, [0])[0]
+        dir = os.path.dirname(rpath)
+        while True:
+          totals = rollup.setdefault(dir or os.curdir, {}).setdefault(category, [0, 0])
+          totals[0] += 1
+          totals[1] += size
+          if not dir:
+            break
+          dir = os.path.dirname(dir)
+    return rollup
+
   def old_targets(self, keys):
     both = {}
     both.update(self.old_intermediates(keys))
     both.update(self.old_terminals(keys))
     return both
 
+  def merge_scope(self, key, scope, child, child_key):
+    """Fold a scoped audit's entry into key, replacing whatever it had under that scope.
+
+    This is how a parent key comes to describe the combined result
+    of several scoped audits; COMMENT['SCOPES'] maps each scope to
+    the key it was recorded under in its own database. Files under
+    a scope nested within this one are left to the nested scope.
+
+    """
+    entry = self.db.setdefault(key, {})
+    comment = entry.setdefault('COMMENT', {})
+    scopes = comment.setdefault('SCOPES', {})
+    prefix = '' if scope == os.curdir else scope + os.sep
+    nested = [s + os.sep for s in scopes if s != scope and s != os.curdir and s.startswith(prefix)]
+    def owned(rpath):
+      return rpath.startswith(prefix) and not [n for n in nested if rpath.startswith(n)]
+    for category in ('PREREQS', 'INTERMEDIATES', 'TERMINALS', 'UNUSED', 'STATS', 'VOLATILE'):
+      data = entry.setdefault(category, {})
+      for rpath in [rp for rp in data if owned(rp)]:
+        del data[rpath]
+      data.update((rp, v) for rp, v in child.get(category, {}).items() if owned(rp))
+    for field, value in child['COMMENT'].items():
+      comment.setdefault(field, value)
+    scopes[scope] = child_key
+    verbose("Merging scope '%s' into '%s'" % (scope, key))
+
+  def scoped(self, key):
+    """Tell whether key was recorded by scoped audits, so its prereqs leave out what was read outside them."""
+    comment = self.db[key]['COMMENT'] if key in self.db else {}
+    return 'SCOPE' in comment or 'SCOPES' in comment
+
+  def fingerprint(self, key):
+    """Return the environment fingerprint recorded for key, if any."""
+    return self.db[key]['COMMENT'].get('FINGERPRINT') if key in self.db else None
+
   def bldtime(self, key):
     return self.db[key]['COMMENT']['BLDTIME']
 
   def baseurl(self, key):
     return self.db[key]['COMMENT']['BASEURL'] if key in self.db else None
 
-  def setup(self, indir):
+  def setup(self, indir, scope=os.curdir):
     """Set a unique file reference time and prepare for the build.
 
     Different filesystems have different granularities for time
@@ -80,21 +385,26 @@ class BuildAudit:
     file previously accessed within the same filesystem and same
     thread, and no newer than any timestamp created subsequently.
 
+    Only the files under scope, a subdirectory of indir, take part
+    in the audit, though their paths are still recorded relative
+    to indir.
+
     """
+    self.scope = scope
+    scandir = os.path.join(indir, scope)
 
     # There are some builds which touch their prerequisites,
     # causing them to look like targets. To protect against
     # that we use the belt-and-suspenders approach of checking
     # against a list of files which predated the build.
     self.pre_existing = {}
-    for parent, dir_names, file_names in os.walk(indir):
+    for parent, dir_names, file_names in os.walk(scandir):
       dir_names[:] = (dn for dn in dir_names if not dn.startswith('.svn'))
       for file_name in file_names:
         rpath = os.path.relpath(os.path.join(parent, file_name), indir)
         self.pre_existing[rpath] = True
 
-    self.ref_file = '.audit-ref.tmp'
-    ref = os.path.join(indir, self.ref_file)
+    ref = os.path.join(scandir, self.ref_file)
 
     def get_time_past(previous):
       this_mtime = this_atime = 0
@@ -112,31 +422,180 @@ class BuildAudit:
 
     mtime1, atime1 = get_time_past(0)
     mtime2, atime2 = get_time_past(mtime1)
+    self.mtime_ref = mtime2
     if atime2 > atime1:
       self.reftime = mtime2
     else:
       self.reftime = -1
       os.remove(ref)
 
+  def ignored(self, name):
+    """Tell whether a file is one of the audit's own, not the build's."""
+    return name == self.ref_file or is_registry(name)
+
   def noatime(self):
     return self.reftime == -1
 
-  def update(self, key, basedir, bldtime, baseurl, replace):
+  def modified(self, basedir):
+    """Return the files under basedir written since setup(), judging by mtime alone."""
+    results = {}
+    def visit(data, parent, files):
+      for fn in files:
+        if self.ignored(fn):
+          continue
+        path = os.path.join(parent, fn)
+        if not os.path.isdir(path) and os.lstat(path).st_mtime >= self.mtime_ref:
+          results[os.path.relpath(path, basedir)] = 'T'
+    os.path.walk(os.path.join(basedir, self.scope), visit, None)
+    return results
+
+  def update_mtime_only(self, key, basedir, bldtime, commit=True):
+    """Record the targets of a build on a noatime mount, judging by mtime alone.
+
+    Without access times nothing can be said about what was read,
+    so the existing entry for key keeps its prereqs, flagged in the
+    COMMENT as unverified until the next full audit replaces them,
+    and just gains whatever was written: a known prereq or
+    intermediate keeps its category and anything else becomes a
+    terminal target. Returns the files written, whether or not the
+    database was changed (it isn't for a key never audited).
+
+    """
+    written = self.modified(basedir)
+    self.new_targets.update(written)
+    if key not in self.db:
+      return written
+    entry = self.db[key]
+    stats = entry.setdefault('STATS', {})
+    for rpath in written:
+      st = os.lstat(os.path.join(basedir, rpath))
+      stats[rpath] = [st.st_size, mtime_ns(st), atime_ns(st)]
+      entry['UNUSED'].pop(rpath, None)
+      if rpath not in entry['PREREQS'] and rpath not in entry['INTERMEDIATES']:
+        entry['TERMINALS'][rpath] = 'T'
+    entry['COMMENT']['BLDTIME'] = bldtime
+    entry['COMMENT']['UNVERIFIED'] = "PREREQS not verified: mtime-only audit at %s" % (time.ctime(self.mtime_ref))
+    verbose("Recording %d targets of '%s' by mtime only" % (len(written), key))
+    if commit:
+      self.commit()
+    return written
+
+  def fold(self, key, prereqs, intermediates, terminals, unused, filestats):
+    """Add what an incremental build observed to the existing entry for key.
+
+    Newly written files become targets and newly read ones, unless
+    already known as targets, prereqs; files which have gone away
+    are dropped, and the rest keep their categories. Returns the
+    set of files read or written.
+
+    """
+    entry = self.db[key]
+    categories = ('PREREQS', 'INTERMEDIATES', 'TERMINALS', 'UNUSED')
+    known = set(rp for category in categories[:-1] for rp in entry[category])
+    seen = set()
+
+    def move(rpath, category, tag):
+      for other in categories:
+        if other != category:
+          entry[other].pop(rpath, None)
+      entry[category][rpath] = tag
+      seen.add(rpath)
+
+    targets = self.old_targets([key])
+    for rpath in intermediates:
+      move(rpath, 'INTERMEDIATES', 'I')
+    for rpath in terminals:
+      move(rpath, 'TERMINALS', 'T')
+    for rpath in prereqs:
+      if rpath in targets:
+        # An up-to-date target read by a later step, not a source.
+        seen.add(rpath)
+      else:
+        move(rpath, 'PREREQS', 'P')
+    for rpath in unused:
+      if rpath not in known and rpath not in seen:
+        entry['UNUSED'][rpath] = 'U'
+
+    for category in categories:
+      for rpath in [rp for rp in entry[category] if rp not in filestats]:
+        del entry[category][rpath]
+    entry['STATS'] = filestats
+    return seen
+
+  def merge(self, key, prereqs, intermediates, terminals, unused, filestats, max_age=None):
+    """Fold what an incremental build observed into the existing entry for key (see fold()).
+
+    Each merge of a build which wrote something is a new
+    generation, and SEEN records the last generation in which
+    each prereq was read and each target written. With max_age,
+    prereqs unread for more than that many generations are
+    demoted to UNUSED, so the set doesn't keep growing as the
+    build changes. Targets are never aged while they exist, and
+    since which target a prereq was read for isn't recorded, a
+    prereq is only aged once every target has been rebuilt since
+    it was last read; a build which is already up to date reads
+    no sources and ages nothing.
+
+    """
+    entry = self.db[key]
+    generation = entry['COMMENT'].get('GENERATION', 0)
+    seen = entry.setdefault('SEEN', {})
+    categories = ('PREREQS', 'INTERMEDIATES', 'TERMINALS')
+    for category in categories:
+      for rpath in entry[category]:
+        seen.setdefault(rpath, generation)
+    rebuilt = bool(intermediates or terminals)
+    if rebuilt:
+      generation += 1
+      entry['COMMENT']['GENERATION'] = generation
+
+    for rpath in self.fold(key, prereqs, intermediates, terminals, unused, filestats):
+      if rpath in entry['PREREQS'] or rpath in intermediates or rpath in terminals:
+        seen[rpath] = generation
+    for rpath in [rp for rp in seen if not any(rp in entry[c] for c in categories)]:
+      del seen[rpath]
+    if max_age is not None and rebuilt:
+      oldest = min([seen[rp] for rp in self.old_targets([key])] or [generation])
+      horizon = min(generation - max_age, oldest)
+      for rpath in [rp for rp in entry['PREREQS'] if seen[rp] < horizon]:
+        del entry['PREREQS'][rpath]
+        del seen[rpath]
+        entry['UNUSED'][rpath] = 'U'
+    verbose("Merging generation %d into '%s'" % (generation, key))
+
+  def update(self, key, basedir, bldtime, baseurl, replace, commit=True, refresh=False, digests=False,
+             comment=None, merge=False, max_age=None):
+    """Categorize the files under basedir and record them under key if replace is set.
+
+    Otherwise, with merge, what an incremental build observed is
+    added to the existing entry in a new generation (see merge()),
+    or with refresh, just added to it along with the current file
+    stats (see fold()), e.g. after an incremental build has brought
+    it up to date. With digests, the content
+    hashes of prereqs and targets are recorded too, and
+    any fields in comment are added to the COMMENT. The database
+    is written straight away unless commit is false, in which
+    case it's up to the caller to commit() it later.
+    Returns True if the in-memory database was changed.
+
+    """
     prereqs = {}
     intermediates = {}
     terminals = {}
     unused = {}
+    filestats = {}
     # Note: do NOT use os.walk here.
     # It has a way of updating symlink atimes.
     def visit(data, parent, files):
       if not parent.startswith('.svn'):
         for fn in files:
-          if fn == self.ref_file:
+          if self.ignored(fn):
             continue
           path = os.path.join(parent, fn)
           if not os.path.isdir(path):
             rpath = os.path.relpath(path, basedir)
             stats = os.lstat(path)
+            filestats[rpath] = [stats.st_size, mtime_ns(stats), atime_ns(stats)]
             adelta = stats.st_atime - self.reftime
             mdelta = stats.st_mtime - self.reftime
             if mdelta >= 0:
@@ -150,20 +609,44 @@ class BuildAudit:
               prereqs[rpath] = 'P'
             else:
               unused[rpath] = 'U'
-    os.path.walk(basedir, visit, None)
+    os.path.walk(os.path.join(basedir, self.scope), visit, None)
 
     self.new_targets.update(intermediates)
     self.new_targets.update(terminals)
 
+    def hashes(rpaths):
+      rpaths = sorted(rp for rp in rpaths if rp in filestats and not os.path.islink(os.path.join(basedir, rp)))
+      return dict(zip(rpaths, self.hashes.digests([os.path.join(basedir, rp) for rp in rpaths])))
+
     if not prereqs:
       warnings.warn("empty prereq set - check for 'noatime' mount")
+    elif (merge or refresh) and not replace and key in self.db:
+      entry = self.db[key]
+      if merge:
+        self.merge(key, prereqs, intermediates, terminals, unused, filestats, max_age)
+      else:
+        # The stats alone would vouch for files read for the first
+        # time without their being checked next time.
+        self.fold(key, prereqs, intermediates, terminals, unused, filestats)
+        verbose("Refreshing '%s' with what the build saw" % (key))
+      entry['COMMENT'].update(comment or {})
+      if digests:
+        entry['DIGESTS'] = hashes(list(entry['PREREQS']) + list(self.old_targets([key])))
+      else:
+        entry.pop('DIGESTS', None)
+      if commit:
+        self.commit()
+      return True
     elif replace:
+      # What was seen to vary before still may, so keep it.
+      volatile = self.db.get(key, {}).get('VOLATILE')
       refstr = "%s (%s)" % (str(self.reftime), time.ctime(self.reftime))
       self.db[key] = {
                       'PREREQS': prereqs,
                       'INTERMEDIATES': intermediates,
                       'TERMINALS': terminals,
                       'UNUSED': unused,
+                      'STATS': filestats,
                       'COMMENT': {
                         'BLDTIME': bldtime,
                         'CMDLINE': sys.argv,
@@ -171,9 +654,16 @@ class BuildAudit:
                         'BASEURL': baseurl,
                         }
                      }
+      self.db[key]['COMMENT'].update(comment or {})
+      if volatile:
+        self.db[key]['VOLATILE'] = volatile
+        self.record_volatile(key, {})
+      if digests:
+        self.db[key]['DIGESTS'] = hashes(list(prereqs) + list(intermediates) + list(terminals))
       verbose("Updating database for '%s'" % (key))
-      with open(self.dbfile, "w") as fp:
-        json.dump(self.db, fp, indent=2)
-        fp.write('\n');  # json does not add trailing newline
+      if commit:
+        self.commit()
+      return True
+    return False
 
 # vim: ts=8:sw=2:tw=120:et:
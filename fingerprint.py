@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+import subprocess
+
+from auditutils import file_digest
+
+DEFAULT_TOOLS = ['make', 'cc', 'c++', 'gcc', 'g++', 'cpp', 'ld', 'as', 'ar']
+DEFAULT_VARS = ['PATH', 'CC', 'CXX', 'CPP', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LDLIBS',
+                'LD_LIBRARY_PATH']
+
+def which(name, path=None):
+  """Resolve a command as the shell would, following symlinks; None if not found."""
+  if os.sep in name:
+    candidates = [name]
+  else:
+    candidates = [os.path.join(d or os.curdir, name) for d in (path or os.getenv('PATH', '')).split(os.pathsep)]
+  for candidate in candidates:
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+      return os.path.realpath(candidate)
+  return None
+
+def make_version(make='make'):
+  try:
+    proc = subprocess.Popen([make, '--version'], stdin=open(os.devnull), stdout=subprocess.PIPE,
+                            stderr=open(os.devnull, 'w'))
+    out = proc.communicate()[0]
+  except OSError:
+    return None
+  return out.splitlines()[0].strip() if out else None
+
+def environment_fingerprint(tools=DEFAULT_TOOLS, variables=DEFAULT_VARS, make='make', hasher=None):
+  """Describe the toolchain and environment a build ran with.
+
+  Returns (digest, details): details records, for each tool, the
+  binary it resolves to on PATH and a hash of its contents, the
+  value of each variable (None when unset) and make's version,
+  and digest is a SHA-1 over all of that bar the tools' paths,
+  which needn't match between hosts. Binaries are hashed
+  through hasher (a HashCache) when given, so unchanged tools
+  cost a stat apiece.
+
+  """
+  digest_file = hasher.digest if hasher else file_digest
+  found = {}
+  for tool in sorted(set(tools) | set([make])):
+    path = which(tool)
+    found[tool] = [path, digest_file(path)] if path else None
+  details = {
+    'TOOLS': found,
+    'VARS': dict((var, os.getenv(var)) for var in sorted(set(variables))),
+    'MAKE_VERSION': make_version(make),
+  }
+  h = hashlib.sha1()
+  h.update(json.dumps(dict(details, TOOLS=dict((t, f and f[1]) for t, f in found.items())), sort_keys=True))
+  return h.hexdigest(), details
+
+# vim: ts=8:sw=2:tw=120:et:
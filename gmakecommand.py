@@ -1,4 +1,5 @@
 import atexit
+import collections
 import datetime
 import optparse
 import os
@@ -9,6 +10,7 @@ import time
 
 import shared
 from auditutils import recreate_dir, verbose
+from jobserver import parse_makeflags
 
 class GMakeCommand(object):
   """Parse a GNU make command line to see which args affect build output.
@@ -34,6 +36,13 @@ class GMakeCommand(object):
   def __init__(self, argv):
     self.argv = argv
 
+    # A -j with no number takes no argument, which optparse can't
+    # express; make it explicit so it doesn't swallow a target.
+    args = list(argv[1:])
+    for i, arg in enumerate(args):
+      if arg in ('-j', '--jobs') and not (i + 1 < len(args) and args[i + 1].isdigit()):
+        args[i] = '--jobs=0'
+
     # Strip out the flags which don't change build artifacts.
     parse_ignored = GMakeCommand.PassThroughOptionParser()
     parse_ignored.add_option('-f', '--file', type='string')
@@ -43,7 +52,16 @@ class GMakeCommand(object):
     parse_ignored.add_option('-w', '--print-directory', action='store_true')
     parse_ignored.add_option(      '--no-print-directory', action='store_true')
     parse_ignored.add_option(      '--warn-undefined-variables', action='store_true')
-    ignored_opts, survivors = parse_ignored.parse_args(argv[1:])
+    ignored_opts, survivors = parse_ignored.parse_args(args)
+
+    # These don't change the output but do say how much of the
+    # machine we may use; 0 means -j without a limit.
+    mf_jobs, mf_load, self.jobserver_auth = parse_makeflags(os.getenv('MAKEFLAGS', ''))
+    self.jobs = int(ignored_opts.jobs) if (ignored_opts.jobs or '').isdigit() else mf_jobs
+    try:
+      self.load_average = float(ignored_opts.load_average)
+    except (TypeError, ValueError):
+      self.load_average = mf_load
 
     # Grab the flag that changes the actual build dir if present;
     # we'll need it.
@@ -110,12 +128,28 @@ class GMakeCommand(object):
       elapsed = str(datetime.timedelta(seconds=e))
       print >> sys.stderr, "Elapsed: %s (build time: %s)" % (elapsed, bldstr)
 
-  def execute_in(self, dir, start_time):
+  def execute_in(self, dir, start_time, capture=False):
+    """Run the build in dir, optionally keeping the tail of its output in self.output."""
     verbose(self.argv)
+    # Recursive makes which come back through AuditMake can tell
+    # from this that they're part of an audit already.
+    env = dict(os.environ, AB_AUDIT_ACTIVE=str(os.getpid()))
     self.build_start = time.time()
-    rc = subprocess.call(self.argv, cwd=dir, stdin=open(os.devnull))
+    if capture:
+      self.output = collections.deque(maxlen=5000)
+      subproc = subprocess.Popen(self.argv, cwd=dir, stdin=open(os.devnull), env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      for line in iter(subproc.stdout.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        self.output.append(line)
+      rc = subproc.wait()
+    else:
+      rc = subprocess.call(self.argv, cwd=dir, stdin=open(os.devnull), env=env)
     self.build_end = time.time()
-    atexit.register(GMakeCommand.printstats, self, start_time)
+    if not hasattr(self, 'stats_registered'):
+      atexit.register(GMakeCommand.printstats, self, start_time)
+      self.stats_registered = True
     return rc
 
 # vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from auditutils import ctime_ns, file_digest, file_lock, load_json, mtime_ns, parallel_map, write_json
+
+# A file changed within this long of being hashed may change again
+# without its timestamps showing it (cf. git's "racily clean" index
+# entries), so its hash is used but not remembered.
+RACY_NS = 2 * 10 ** 9
+
+# Entries nobody has asked for in this many days are dropped.
+MAX_AGE_DAYS = 30
+
+class HashCache(object):
+  """Remember file content hashes for as long as the file evidently hasn't changed.
+
+  Entries are keyed by (device, inode, size, mtime_ns, ctime_ns),
+  which any write to the file or rename over it would change,
+  so a hit needs no more than the lstat the caller usually has in
+  hand anyway. Keys don't depend on paths, so one cache serves the
+  source tree and the external tree alike. The cache is loaded
+  on first use and save() merges what was learned into the file
+  under a lock, so concurrent builds can share it.
+
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.entries = None
+    self.added = {}
+    self.today = int(time.time() // 86400)
+
+  @staticmethod
+  def stat_key(st):
+    return '%d:%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, mtime_ns(st), ctime_ns(st))
+
+  def load(self):
+    return load_json(self.path)
+
+  def digest(self, path, st=None):
+    """Return the SHA-1 hex digest of a file's contents, hashing it only if need be."""
+    if st is None:
+      st = os.stat(path)
+    key = self.stat_key(st)
+    with self.lock:
+      if self.entries is None:
+        self.entries = self.load()
+      entry = self.entries.get(key)
+      if entry:
+        if entry[1] != self.today:
+          entry[1] = self.today
+          self.added[key] = entry
+        return entry[0]
+    digest = file_digest(path)
+    if max(mtime_ns(st), ctime_ns(st)) < time.time() * 1e9 - RACY_NS:
+      with self.lock:
+        self.entries[key] = self.added[key] = [digest, self.today]
+    return digest
+
+  def digests(self, paths, jobs=None):
+    """Return the digests of many files, hashing any that need it in parallel."""
+    return parallel_map(self.digest, paths, jobs)
+
+  def locked(self):
+    return file_lock(self.path + '.lock')
+
+  def save(self):
+    """Merge new and refreshed entries into the file, dropping long unused ones."""
+    with self.lock:
+      if not self.added:
+        return
+      added, self.added = self.added, {}
+    with self.locked():
+      entries = self.load()
+      entries.update(added)
+      for key in [k for k, e in entries.items() if e[1] < self.today - MAX_AGE_DAYS]:
+        del entries[key]
+      write_json(self.path, entries)
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,85 @@
+import errno
+import fcntl
+import os
+import re
+import select
+import threading
+
+class JobServer(object):
+  """Take and return job slots from the GNU make jobserver we're running under.
+
+  Any process started by make holds one slot implicitly; each
+  further concurrent job needs a token read from the jobserver
+  and written back when done. This lets our own worker threads
+  run alongside make's jobs without exceeding the user's -j.
+  Both the classic pipe ('R,W') and the fifo ('fifo:PATH')
+  forms of --jobserver-auth are understood.
+
+  """
+  def __init__(self, rfd, wfd):
+    self.rfd = rfd
+    self.wfd = wfd
+    self.implicit = threading.Lock()
+
+  @classmethod
+  def from_auth(cls, auth):
+    """Return a JobServer for a --jobserver-auth value, or None if it's not usable."""
+    if not auth:
+      return None
+    try:
+      if auth.startswith('fifo:'):
+        fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+        return cls(fd, fd)
+      rfd, wfd = [int(fd) for fd in auth.split(',')]
+      if rfd < 0 or wfd < 0:
+        return None
+      # Make only passes the descriptors on to commands it knows
+      # to be recursive makes, so check they're really there.
+      fcntl.fcntl(rfd, fcntl.F_GETFD)
+      fcntl.fcntl(wfd, fcntl.F_GETFD)
+      return cls(rfd, wfd)
+    except (ValueError, OSError, IOError):
+      return None
+
+  def acquire(self):
+    """Block until a slot is free and return a token for it."""
+    if self.implicit.acquire(False):
+      return None
+    while True:
+      # Make may have put the shared pipe into non-blocking mode.
+      select.select([self.rfd], [], [])
+      try:
+        token = os.read(self.rfd, 1)
+      except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EINTR):
+          continue
+        raise
+      if token:
+        return token
+
+  def release(self, token):
+    if token is None:
+      self.implicit.release()
+    else:
+      os.write(self.wfd, token)
+
+def parse_makeflags(makeflags):
+  """Return (jobs, load_average, jobserver_auth) as found in a MAKEFLAGS value.
+
+  jobs is 0 for an unlimited -j and None when it's not given.
+
+  """
+  makeflags = re.sub(r'\s+--\s+.*', '', makeflags)
+  jobs = load = auth = None
+  match = re.search(r'(?:^|\s)-\w*j(\d*)', makeflags)
+  if match:
+    jobs = int(match.group(1)) if match.group(1) else 0
+  match = re.search(r'(?:^|\s)-\w*l(\d+(?:\.\d+)?)', makeflags)
+  if match:
+    load = float(match.group(1))
+  match = re.search(r'--jobserver-(?:auth|fds)=(\S+)', makeflags)
+  if match:
+    auth = match.group(1)
+  return jobs, load, auth
+
+# vim: ts=8:sw=2:tw=120:et:
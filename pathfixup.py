@@ -0,0 +1,84 @@
+import mmap
+import os
+import shutil
+import stat
+import tempfile
+
+from auditutils import parallel_map, verbose
+
+# How much of a file to sniff when deciding whether it's text.
+SNIFF_SIZE = 512
+
+# Control characters which legitimately appear in text files.
+_TEXT_CONTROLS = frozenset('\b\t\n\f\r\x1b')
+
+def is_text(block):
+  """Guess whether a leading block of file data is text, much as Perl's -T does.
+
+  A NUL byte means binary. Otherwise the block is considered
+  text unless more than 30% of it is control characters. Bytes
+  with the high bit set are allowed since they occur in UTF-8.
+
+  """
+  if not block:
+    return True
+  if '\0' in block:
+    return False
+  odd = sum(1 for c in block if c < ' ' and c not in _TEXT_CONTROLS)
+  return odd * 10 <= len(block) * 3
+
+def fixed_up(path, old, new):
+  """Return the contents of a text file with old replaced by new, or None if it needs no fixing up.
+
+  The file is searched in place via mmap and only read in full
+  if the pattern occurs.
+
+  """
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return None
+  if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+    return None
+
+  with open(path, 'rb') as fp:
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if mm.find(old) < 0 or not is_text(mm[:SNIFF_SIZE]):
+        return None
+      return mm[:].replace(old, new)
+    finally:
+      mm.close()
+
+def fixup_file(path, old, new):
+  """Replace old with new throughout a text file; return True if it changed.
+
+  The file is left untouched unless the pattern occurs. A
+  rewritten file replaces the original atomically and keeps
+  its mode and timestamps.
+
+  """
+  data = fixed_up(path, old, new)
+  if data is None:
+    return False
+
+  parent, name = os.path.split(path)
+  fd, tmp = tempfile.mkstemp(prefix='.' + name + '.', dir=parent)
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(data)
+    shutil.copystat(path, tmp)
+    os.rename(tmp, path)
+  except:
+    os.remove(tmp)
+    raise
+  return True
+
+def fixup_files(paths, old, new, jobs=None):
+  """Run fixup_file over a set of files in parallel; return the list changed."""
+  paths = sorted(paths)
+  changed = [p for p, c in zip(paths, parallel_map(lambda p: fixup_file(p, old, new), paths, jobs)) if c]
+  verbose("Fixed up %d of %d files" % (len(changed), len(paths)))
+  return changed
+
+# vim: ts=8:sw=2:tw=120:et:
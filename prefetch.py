@@ -0,0 +1,97 @@
+import ctypes
+import os
+import threading
+
+from auditutils import libc_function, parallel_map, verbose
+
+CHUNK = 1024 * 1024
+
+# Python 2's os has no posix_fadvise; Linux's value for the advice is fixed.
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+_posix_fadvise = libc_function(['posix_fadvise64', 'posix_fadvise'], ctypes.c_int,
+                               [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+
+def will_need(fd):
+  """posix_fadvise(fd, 0, 0, WILLNEED): start reading the whole file into the page cache."""
+  if hasattr(os, 'posix_fadvise'):
+    os.posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    return
+  err = _posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+  if err:
+    raise OSError(err, os.strerror(err))  # returned, not left in errno
+
+# Prefetching overlaps the start of the build, so it keeps to a few
+# threads of its own rather than taking job slots make could use.
+JOBS = 4
+
+class Prefetcher(object):
+  """Warm the page cache with the files a build is expected to read.
+
+  Files are visited in the order given, from a background pool
+  of threads. Where posix_fadvise is available it just issues
+  WILLNEED; otherwise the file is read and discarded through an
+  O_NOATIME descriptor. Either way no access times change, which
+  matters since atimes are how the audit recognizes prereqs.
+  Files which can't be prefetched without touching their atime
+  are skipped. The pool holds no make jobserver slots, since it
+  runs alongside the very build it's there to help.
+
+  """
+  def __init__(self, basedir, rpaths, jobs=JOBS):
+    self.basedir = basedir
+    self.rpaths = rpaths
+    self.jobs = jobs
+    self.done = threading.Event()
+    self.lock = threading.Lock()
+    self.fetched = 0
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    """Abandon whatever is left, e.g. because the build has finished."""
+    self.done.set()
+    if self.thread:
+      self.thread.join()
+      verbose("Prefetched %d of %d files" % (self.fetched, len(self.rpaths)))
+
+  def run(self):
+    parallel_map(self.fetch, self.rpaths, self.jobs, slotted=False)
+
+  def fetch(self, rpath):
+    if self.done.is_set():
+      return
+    path = os.path.join(self.basedir, rpath)
+    try:
+      if hasattr(os, 'posix_fadvise') or _posix_fadvise is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+          will_need(fd)
+        finally:
+          os.close(fd)
+      elif hasattr(os, 'O_NOATIME'):
+        fd = os.open(path, os.O_RDONLY | os.O_NOATIME)
+        try:
+          while not self.done.is_set() and os.read(fd, CHUNK):
+            pass
+        finally:
+          os.close(fd)
+      else:
+        return
+    except OSError:
+      return  # e.g. EPERM for O_NOATIME on someone else's file
+    with self.lock:
+      self.fetched += 1
+
+def prefetch_order(prereqs, stats):
+  """Order prereqs by recorded access time where known, else by directory."""
+  def order(rpath):
+    st = stats.get(rpath)
+    return (0, st[2], rpath) if st else (1, 0, rpath)
+  return sorted(prereqs, key=order)
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,87 @@
+import os
+import re
+
+from auditutils import dirnames, verbose
+from treecopy import copy_files, excluded
+
+# Ways in which make and the usual tools complain about a missing input.
+_MISSING_PATTERNS = [
+  re.compile(r"No rule to make target [`'\"]([^`'\"]+)['\"]"),
+  re.compile(r"fatal error: ([^\s:]+): No such file or directory"),
+  re.compile(r"([^\s:`'\"]+): No such file or directory"),
+  re.compile(r"[Cc]an(?:no|')t open (?:file |include file )?[`'\"]?([^\s`'\"]+)"),
+]
+
+def missing_inputs(lines):
+  """Return the names of files the build output says were missing."""
+  names = []
+  for line in lines:
+    for pattern in _MISSING_PATTERNS:
+      match = pattern.search(line)
+      if match:
+        name = match.group(1).rstrip('.,;')
+        if name not in names:
+          names.append(name)
+        break
+  return names
+
+def resolve_missing(names, base_dir, build_base, bwd, search_dirs):
+  """Map reported names onto files and directories of base_dir.
+
+  Absolute names are taken relative to either tree. Relative
+  names are tried against the build directory, then against
+  the tree root and each of search_dirs, which should be the
+  directories the build is known to read from; that catches
+  headers reported relative to an include path.
+
+  Returns the set of files found, and the set of directories
+  the missing inputs are likely to be in. A name which isn't
+  itself a file (e.g. a target whose source is what's actually
+  missing) still contributes the directory it would be in.
+
+  """
+  files = set()
+  dirs = set()
+  for name in names:
+    if os.path.isabs(name):
+      primary = [os.path.relpath(name, root) for root in (build_base, base_dir) if name.startswith(root + os.sep)]
+      secondary = []
+    else:
+      primary = [os.path.relpath(os.path.join(bwd, name), build_base), name]
+      secondary = [os.path.join(d, name) for d in sorted(search_dirs)]
+    for rpath in primary + secondary:
+      rpath = os.path.normpath(rpath)
+      if rpath.startswith(os.pardir):
+        continue
+      if os.path.isfile(os.path.join(base_dir, rpath)):
+        files.add(rpath)
+        dirs.add(os.path.dirname(rpath))
+      elif rpath in primary and os.path.isdir(os.path.join(base_dir, os.path.dirname(rpath))):
+        dirs.add(os.path.dirname(rpath))
+  return files, dirs
+
+def fetch_missing(lines, base_dir, build_base, bwd, prereqs, excludes=(), copier='rsync'):
+  """Copy the inputs a failed build reported missing, along with their directories.
+
+  Files in the directories concerned which the external tree
+  lacks are copied too, since a file new to the build often
+  arrives with others. Returns the relative paths copied, which
+  is empty when there was nothing to be done.
+
+  """
+  names = missing_inputs(lines)
+  if not names:
+    return []
+  files, dirs = resolve_missing(names, base_dir, build_base, bwd, dirnames(prereqs))
+  for dir in dirs:
+    for fn in os.listdir(os.path.join(base_dir, dir)):
+      files.add(os.path.normpath(os.path.join(dir, fn)))
+  fetch = sorted(rp for rp in files if os.path.isfile(os.path.join(base_dir, rp))
+                 and not os.path.lexists(os.path.join(build_base, rp))
+                 and not excluded(rp, excludes))
+  if fetch:
+    verbose("Fetching %d files for missing inputs: %s" % (len(fetch), ' '.join(names)))
+    copy_files(base_dir, build_base, fetch, excludes, copier=copier, label='Recovery')
+  return fetch
+
+# vim: ts=8:sw=2:tw=120:et:
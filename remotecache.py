@@ -0,0 +1,140 @@
+import hashlib
+import httplib
+import json
+import os
+import re
+import socket
+import threading
+import urlparse
+
+from artifactcache import SYMLINK
+from auditutils import verbose
+
+CHUNK = 1024 * 1024
+TIMEOUT = 10
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+
+class RemoteCache(object):
+  """Client for an artifact cache shared over HTTP, behind a local ArtifactCache.
+
+  The protocol is deliberately small; AuditCacheServer implements it:
+
+    GET|HEAD /objects/<sha1>    the object with those contents
+    PUT      /objects/<sha1>    store an object; the server checks the digest
+    GET      /entries/<digest>  an entry, as JSON {target: [sha1, mode] or ['symlink', text]}
+    PUT      /entries/<digest>  store an entry, once its objects are in place
+
+  Everything is streamed in chunks. Any failure to connect or
+  time out marks the server as down for the rest of the run, so
+  a slow or missing cache costs one timeout at most and the build
+  simply goes ahead as though the cache had missed.
+
+  """
+  def __init__(self, url, timeout=TIMEOUT):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      raise ValueError("not an http(s) URL: %s" % (url))
+    self.https = parts.scheme == 'https'
+    self.netloc = parts.netloc
+    self.prefix = parts.path.rstrip('/')
+    self.timeout = timeout
+    self.down = False
+    self.lock = threading.Lock()
+
+  def request(self, method, path, body=None, headers=None):
+    """Return (response, connection), or (None, None) if the server can't be reached."""
+    if self.down:
+      return None, None
+    conn_class = httplib.HTTPSConnection if self.https else httplib.HTTPConnection
+    conn = conn_class(self.netloc, timeout=self.timeout)
+    try:
+      conn.request(method, self.prefix + path, body, headers or {})
+      return conn.getresponse(), conn
+    except (socket.error, httplib.HTTPException, IOError) as e:
+      conn.close()
+      self.fail(e)
+      return None, None
+
+  def fail(self, e):
+    with self.lock:
+      if not self.down:
+        verbose("Remote artifact cache unavailable, going without: %s" % (e))
+      self.down = True
+
+  def get_entry(self, digest):
+    resp, conn = self.request('GET', '/entries/' + digest)
+    if resp is None:
+      return None
+    try:
+      if resp.status != 200:
+        return None
+      entry = json.loads(resp.read())
+      # It names files to write, so make sure it stays in the tree.
+      for rpath, (content, mode) in entry.items():
+        if content == SYMLINK:
+          valid = isinstance(mode, basestring)
+        else:
+          valid = DIGEST_RE.match(content) and isinstance(mode, (int, long))
+        if os.path.isabs(rpath) or os.pardir in rpath.split(os.sep) or not valid:
+          verbose("Ignoring bad remote entry %s" % (digest))
+          return None
+      return entry
+    except (socket.error, httplib.HTTPException) as e:
+      self.fail(e)
+      return None
+    except (ValueError, TypeError, AttributeError):
+      verbose("Ignoring bad remote entry %s" % (digest))
+      return None
+    finally:
+      conn.close()
+
+  def get_object(self, content, dst):
+    """Download an object into dst; return True if it arrived whole and intact."""
+    resp, conn = self.request('GET', '/objects/' + content)
+    if resp is None:
+      return False
+    try:
+      if resp.status != 200:
+        return False
+      h = hashlib.sha1()
+      with open(dst, 'wb') as fp:
+        while True:
+          buf = resp.read(CHUNK)
+          if not buf:
+            break
+          h.update(buf)
+          fp.write(buf)
+      return h.hexdigest() == content
+    except (socket.error, httplib.HTTPException) as e:
+      self.fail(e)
+      return False
+    finally:
+      conn.close()
+
+  def has_object(self, content):
+    resp, conn = self.request('HEAD', '/objects/' + content)
+    if resp is None:
+      return True  # nothing to be done about it anyway
+    conn.close()
+    return resp.status == 200
+
+  def put_object(self, content, src):
+    with open(src, 'rb') as fp:
+      size = os.fstat(fp.fileno()).st_size
+      resp, conn = self.request('PUT', '/objects/' + content, fp, {'Content-Length': str(size)})
+    if resp is None:
+      return False
+    conn.close()
+    return resp.status in (200, 201, 204)
+
+  def put_entry(self, digest, entry):
+    body = json.dumps(entry, sort_keys=True)
+    resp, conn = self.request('PUT', '/entries/' + digest, body,
+                              {'Content-Length': str(len(body)), 'Content-Type': 'application/json'})
+    if resp is None:
+      return False
+    conn.close()
+    return resp.status in (200, 201, 204)
+
+# vim: ts=8:sw=2:tw=120:et:
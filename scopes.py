@@ -0,0 +1,93 @@
+import os
+import time
+
+from auditutils import file_lock, load_json, pid_alive, update_json, verbose
+
+# The registry's name within a tree built in place, where audits
+# pass over it (and its lock and temporary files).
+REGISTRY = '.audit-scopes.json'
+
+def is_registry(name):
+  """Tell whether a file name is the registry's, or its lock's or temporary file's."""
+  return name.lstrip('.').startswith(REGISTRY.lstrip('.'))
+
+def overlaps(a, b):
+  """Tell whether two scopes (paths relative to the base of the tree) share any files."""
+  if os.curdir in (a, b) or a == b:
+    return True
+  return a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+class ScopeCoordinator(object):
+  """Let scoped audits of disjoint parts of one build tree run side by side.
+
+  A scoped audit only scans, records and copies back the files
+  under its scope, so audits of different subdirectories can run
+  concurrently as long as their scopes don't overlap; the whole
+  tree is the scope '.'. Each audit registers its scope here for
+  as long as it runs, and one whose scope overlaps another live
+  audit's waits for that audit to finish. The registry lives
+  beside an external build tree, or at the top of a tree built
+  in place, under an exclusive file lock which also serves to
+  serialize work on the shared parts of the tree.
+
+  """
+  def __init__(self, build_base, in_place=False, poll=0.5):
+    if in_place:
+      self.path = os.path.join(build_base, REGISTRY)
+    else:
+      self.path = build_base.rstrip(os.sep) + '.scopes.json'
+    self.poll = poll
+    self.scope = None
+
+  def exclusive(self):
+    """Hold the registry lock, e.g. while updating what all scopes share."""
+    return file_lock(self.path + '.lock')
+
+  @staticmethod
+  def live(scopes):
+    """Drop the registrations of audits which have died from scopes, and return it."""
+    for pid in [p for p in scopes if not pid_alive(int(p))]:
+      del scopes[pid]
+    return scopes
+
+  def load(self):
+    """Return the registry as {pid: scope} for live audits; call with the lock held."""
+    return self.live(load_json(self.path))
+
+  def others(self):
+    """Return the scopes other live audits are working on; call with the lock held.
+
+    They don't overlap ours, but each is being built into, so a
+    copy-out must leave them alone.
+
+    """
+    return sorted(set(s for p, s in self.load().items() if int(p) != os.getpid()))
+
+  def _locked(self, update):
+    """Run update(scopes) with the registry loaded and locked; save and return its result."""
+    return update_json(self.path, lambda scopes: update(self.live(scopes)))
+
+  def acquire(self, scope):
+    """Register scope for this process, waiting out any live audit it overlaps."""
+    def update(scopes):
+      busy = sorted(s for p, s in scopes.items() if int(p) != os.getpid() and overlaps(s, scope))
+      if not busy:
+        scopes[str(os.getpid())] = scope
+      return busy
+    waited = False
+    while True:
+      busy = self._locked(update)
+      if not busy:
+        break
+      if not waited:
+        verbose("Scope '%s' waiting for overlapping audit of %s" % (scope, ', '.join("'%s'" % s for s in busy)))
+        waited = True
+      time.sleep(self.poll)
+    self.scope = scope
+
+  def release(self):
+    if self.scope is not None:
+      self._locked(lambda scopes: scopes.pop(str(os.getpid()), None))
+      self.scope = None
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,93 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import shared
+from artifactcache import ArtifactCache
+
+shared.verbosity = 0
+
+AUDITRUN = os.path.join(HERE, 'auditrun.py')
+
+DIGEST = '0' * 40
+
+class ArtifactCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.dst = os.path.join(self.tmp, 'dst')
+    os.makedirs(os.path.join(self.src, 'lib'))
+    with open(os.path.join(self.src, 'lib', 'libx.so.1'), 'w') as fp:
+      fp.write('library\n')
+    os.symlink('libx.so.1', os.path.join(self.src, 'lib', 'libx.so'))
+    self.targets = ['lib/libx.so', 'lib/libx.so.1']
+
+  def tearDown(self):
+    for parent, dir_names, file_names in os.walk(self.tmp):
+      os.chmod(parent, 0o755)
+    shutil.rmtree(self.tmp)
+
+  def cache(self, mode):
+    return ArtifactCache(os.path.join(self.tmp, 'cache'), mode=mode)
+
+  def test_symlink_target(self):
+    self.assertTrue(self.cache('copy').store(DIGEST, self.src, self.targets))
+    self.assertEqual(self.cache('copy').fetch(DIGEST, self.dst), self.targets)
+    self.assertEqual(os.readlink(os.path.join(self.dst, 'lib', 'libx.so')), 'libx.so.1')
+    with open(os.path.join(self.dst, 'lib', 'libx.so')) as fp:
+      self.assertEqual(fp.read(), 'library\n')
+
+  def test_hardlink(self):
+    cache = self.cache('hardlink')
+    self.assertTrue(cache.store(DIGEST, self.src, self.targets))
+    cache.fetch(DIGEST, self.dst)
+    shared = os.stat(os.path.join(self.dst, 'lib', 'libx.so.1')).st_nlink > 1
+    # Root could write through a link into the store.
+    self.assertEqual(shared, os.geteuid() != 0)
+
+class ArtifactStoreTest(unittest.TestCase):
+  """What audited builds with --artifact-cache put in the cache."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.cache = os.path.join(self.tmp, 'cache')
+    os.makedirs(self.src)
+    with open(os.path.join(self.src, 'Makefile'), 'w') as fp:
+      fp.write('out.txt: a.txt $(shell cat a.txt)\n\tcat $$(cat a.txt) > $@\n')
+    for name, text in (('a.txt', 'x.txt\n'), ('x.txt', 'x\n'), ('y.txt', 'y\n')):
+      with open(os.path.join(self.src, name), 'w') as fp:
+        fp.write(text)
+    for name in ('Makefile', 'a.txt', 'x.txt', 'y.txt'):
+      subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.src, name)])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def audit(self, *opts):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '-k', 'all',
+           '--artifact-cache', self.cache] + list(opts) + ['--', 'make', '-s']
+    return subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                           stderr=subprocess.STDOUT)
+
+  def test_incremental_build_not_stored(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    self.assertEqual(len(os.listdir(os.path.join(self.cache, 'entries'))), 1)
+    with open(os.path.join(self.src, 'a.txt'), 'w') as fp:
+      fp.write('y.txt\n')
+    # The key doesn't know this build read y.txt, so its digest
+    # would match any tree whatever y.txt held.
+    self.assertEqual(self.audit(), 0)
+    self.assertEqual(len(os.listdir(os.path.join(self.cache, 'entries'))), 1)
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from AuditMake import make_is_special
+from gmakecommand import GMakeCommand
+
+COMMAND_LINES = [
+  'make',
+  'make all install',
+  'make -s -w all',
+  'make -j8 all',
+  'make -j 8 all',
+  'make -j all',
+  'make -j -B',
+  'make -sj -B',
+  'make -C src all',
+  'make -Csrc -k',
+  'make -f other.mk -n',
+  'make -fB',
+  'make -B',
+  'make -sB',
+  'make -n',
+  'make -q all',
+  'make -I include',
+  'make -o foo.o',
+  'make -W foo.c',
+  'make -t',
+  'make -Otarget',
+  'make -Orecurse all',
+  'make -Onone',
+  'make -O',
+  'make -d',
+  'make -E X:=1',
+  'make --always-make',
+  'make --dry-run',
+  'make --directory src',
+  'make --directory -B',
+  'make --file=x.mk --touch',
+  'make --jobs -k',
+  'make --output-sync=target',
+  'make --no-print-directory all',
+  'make CFLAGS=-O2 all',
+  'make -',
+]
+
+class MakeIsSpecialTest(unittest.TestCase):
+  """The launcher's quick look at a make command line against GMakeCommand's."""
+
+  def setUp(self):
+    self.makeflags = os.environ.pop('MAKEFLAGS', None)
+
+  def tearDown(self):
+    if self.makeflags is not None:
+      os.environ['MAKEFLAGS'] = self.makeflags
+
+  def test_agrees_with_gmakecommand(self):
+    for line in COMMAND_LINES:
+      argv = line.split()
+      special = make_is_special(argv)
+      # None passes the decision on to GMakeCommand itself.
+      if special is not None:
+        self.assertEqual(special, GMakeCommand(argv).special_case, line)
+
+  def test_output_sync_audited(self):
+    for line in ('make -Otarget', 'make -Orecurse', 'make -Onone'):
+      self.assertFalse(GMakeCommand(line.split()).special_case)
+      self.assertNotEqual(make_is_special(line.split()), True, line)
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,151 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import shared
+from auditutils import atime_ns, mtime_ns
+from buildaudit import BuildAudit
+
+shared.verbosity = 0
+
+AUDITRUN = os.path.join(HERE, 'auditrun.py')
+AUDITDUMP = os.path.join(os.path.dirname(HERE), 'AuditDump.py')
+
+# Sub-microsecond mtimes, which a copy through utimes() truncates.
+STAMPS = ['@1760000000.123456%03d' % (999 - i * 7) for i in range(32)]
+
+class AvoidBuildTest(unittest.TestCase):
+  """An external build copied out and back must be avoidable next time round."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.ext = os.path.join(self.tmp, 'ext')
+    self.log = os.path.join(self.tmp, 'make.log')
+    os.makedirs(self.src)
+    with open(os.path.join(self.src, 'Makefile'), 'w') as fp:
+      # make would skip an up-to-date out.txt anyway, so log every build.
+      fp.write('.PHONY: all\nall: out.txt\n\techo ran >> %s\n' % (self.log))
+      fp.write('out.txt: $(wildcard in*.txt)\n\tcat $^ > $@\n')
+    for i, stamp in enumerate(STAMPS):
+      path = os.path.join(self.src, 'in%02d.txt' % (i))
+      with open(path, 'w') as fp:
+        fp.write('%d\n' % (i))
+      subprocess.check_call(['touch', '-d', stamp, path])
+    subprocess.check_call(['touch', '-d', STAMPS[0], os.path.join(self.src, 'Makefile')])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def audit(self, *opts):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '--copier', 'native',
+           '-x', self.ext, '-k', 'all'] + list(opts) + ['--', 'make', '-s']
+    return subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                           stderr=subprocess.STDOUT)
+
+  def stale(self):
+    cmd = [sys.executable, AUDITDUMP, '-S', '-k', 'all']
+    return subprocess.call(cmd, cwd=self.src, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+  def runs(self):
+    with open(self.log) as fp:
+      return len(fp.readlines())
+
+  def test_avoided_after_copy_out_and_in(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    self.assertEqual(self.runs(), 1)
+    self.assertTrue(os.path.exists(os.path.join(self.src, 'out.txt')))
+    self.assertEqual(self.audit('--avoid-build'), 0)
+    self.assertEqual(self.runs(), 1)
+
+  def test_not_stale_after_copy_out_and_in(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    self.assertEqual(self.stale(), 0)
+    with open(os.path.join(self.src, 'in03.txt'), 'a') as fp:
+      fp.write('changed\n')
+    self.assertEqual(self.stale(), 1)
+
+  def test_rebuilt_after_change(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    with open(os.path.join(self.src, 'in03.txt'), 'a') as fp:
+      fp.write('changed\n')
+    self.assertEqual(self.audit('--avoid-build'), 0)
+    self.assertEqual(self.runs(), 2)
+
+class RestatTest(unittest.TestCase):
+  """Re-recording targets after they've been copied back."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.audit = BuildAudit(dbdir=self.tmp)
+    self.names = ['t%02d' % (i) for i in range(len(STAMPS))]
+    stats = {}
+    for name, stamp in zip(self.names, STAMPS):
+      path = os.path.join(self.tmp, name)
+      with open(path, 'w') as fp:
+        fp.write('target\n')
+      subprocess.check_call(['touch', '-d', stamp, path])
+      st = os.stat(path)
+      stats[name] = [st.st_size, mtime_ns(st), atime_ns(st)]
+      shutil.copy2(path, path + '.copy')
+    self.audit.db['k'] = {'STATS': dict((name + '.copy', stat) for name, stat in stats.items())}
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_copies_unchanged(self):
+    self.assertFalse(self.audit.restat('k', self.tmp, [name + '.copy' for name in self.names]))
+
+  def test_rewritten_copy_changed(self):
+    with open(os.path.join(self.tmp, 't00.copy'), 'a') as fp:
+      fp.write('more\n')
+    self.assertTrue(self.audit.restat('k', self.tmp, [name + '.copy' for name in self.names]))
+
+class InPlaceAvoidBuildTest(unittest.TestCase):
+  """An in-place build whose inputs change between incremental builds."""
+
+  def setUp(self):
+    self.src = tempfile.mkdtemp()
+    with open(os.path.join(self.src, 'Makefile'), 'w') as fp:
+      fp.write('out.txt: a.txt $(shell cat a.txt)\n\tcat $$(cat a.txt) > $@\n')
+    for name, text in (('a.txt', 'x.txt\n'), ('x.txt', 'x\n'), ('y.txt', 'y\n')):
+      self.write(name, text)
+      subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.src, name)])
+    subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.src, 'Makefile')])
+
+  def tearDown(self):
+    shutil.rmtree(self.src)
+
+  def write(self, name, text):
+    with open(os.path.join(self.src, name), 'w') as fp:
+      fp.write(text)
+
+  def audit(self, *opts):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '-k', 'all']
+    cmd += list(opts) + ['--', 'make', '-s']
+    return subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                           stderr=subprocess.STDOUT)
+
+  def test_input_first_read_by_incremental_build(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    self.write('a.txt', 'y.txt\n')
+    self.assertEqual(self.audit('--avoid-build'), 0)
+    with open(os.path.join(self.src, 'out.txt')) as fp:
+      self.assertEqual(fp.read(), 'y\n')
+    # y.txt was only read by the incremental build, so only
+    # recorded if that build's prereqs were added to the key.
+    self.write('y.txt', 'new y\n')
+    self.assertEqual(self.audit('--avoid-build'), 0)
+    with open(os.path.join(self.src, 'out.txt')) as fp:
+      self.assertEqual(fp.read(), 'new y\n')
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
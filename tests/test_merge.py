@@ -0,0 +1,105 @@
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import shared
+from buildaudit import BuildAudit
+
+shared.verbosity = 0
+
+AUDITRUN = os.path.join(HERE, 'auditrun.py')
+
+MAKEFILE = 'prog: a.o b.o\n\tcat $^ > $@\n%.o: %.c\n\tcat $< > $@\n'
+
+class MergeTest(unittest.TestCase):
+  """Generations and aging in merge(), fed what each build saw."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.audit = BuildAudit(dbdir=self.tmp)
+    files = ['Makefile', 'a.c', 'b.c', 'a.o', 'b.o', 'prog']
+    self.stats = dict((rp, [1, 0, 0]) for rp in files)
+    self.audit.db['k'] = {
+      'PREREQS': {'Makefile': 'P', 'a.c': 'P', 'b.c': 'P'},
+      'INTERMEDIATES': {'a.o': 'I', 'b.o': 'I'},
+      'TERMINALS': {'prog': 'T'},
+      'UNUSED': {},
+      'STATS': self.stats,
+      'COMMENT': {},
+    }
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def merge(self, read, written, times=3):
+    for i in range(times):
+      prereqs = dict((rp, 'P') for rp in read)
+      intermediates = dict((rp, 'I') for rp in written if rp.endswith('.o'))
+      terminals = dict((rp, 'T') for rp in written if not rp.endswith('.o'))
+      self.audit.merge('k', prereqs, intermediates, terminals, {}, self.stats, max_age=1)
+    return self.audit.db['k']
+
+  def test_up_to_date_builds_age_nothing(self):
+    entry = self.merge(['Makefile'], [])
+    self.assertEqual(sorted(entry['PREREQS']), ['Makefile', 'a.c', 'b.c'])
+    self.assertEqual(sorted(entry['INTERMEDIATES']), ['a.o', 'b.o'])
+    self.assertEqual(sorted(entry['TERMINALS']), ['prog'])
+    self.assertEqual(entry['COMMENT'].get('GENERATION', 0), 0)
+
+  def test_prereqs_of_targets_not_rebuilt_kept(self):
+    entry = self.merge(['Makefile', 'a.c', 'a.o', 'b.o'], ['a.o', 'prog'])
+    self.assertEqual(sorted(entry['PREREQS']), ['Makefile', 'a.c', 'b.c'])
+    self.assertEqual(sorted(entry['INTERMEDIATES']), ['a.o', 'b.o'])
+    self.assertEqual(entry['UNUSED'], {})
+
+  def test_prereq_aged_once_every_target_rebuilt(self):
+    # a.o now comes from b.c too, and a.c is no longer read.
+    entry = self.merge(['Makefile', 'b.c', 'a.o', 'b.o'], ['a.o', 'b.o', 'prog'])
+    self.assertEqual(sorted(entry['PREREQS']), ['Makefile', 'b.c'])
+    self.assertEqual(entry['UNUSED'], {'a.c': 'U'})
+    self.assertEqual(sorted(entry['INTERMEDIATES']), ['a.o', 'b.o'])
+    self.assertEqual(sorted(entry['TERMINALS']), ['prog'])
+
+class MergeBuildTest(unittest.TestCase):
+  """Audited no-op builds with --merge --max-age."""
+
+  def setUp(self):
+    self.src = tempfile.mkdtemp()
+    for name, text in (('Makefile', MAKEFILE), ('a.c', 'a\n'), ('b.c', 'b\n')):
+      with open(os.path.join(self.src, name), 'w') as fp:
+        fp.write(text)
+      subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.src, name)])
+
+  def tearDown(self):
+    shutil.rmtree(self.src)
+
+  def audit(self, *opts):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '-k', 'all']
+    cmd += list(opts) + ['--', 'make', '-s']
+    return subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                           stderr=subprocess.STDOUT)
+
+  def test_up_to_date_builds_keep_the_audit(self):
+    self.assertEqual(self.audit('--fresh'), 0)
+    for i in range(3):
+      # As a strictatime mount would, let make's read of the Makefile show.
+      subprocess.check_call(['touch', '-a', '-d', '2000-01-01', os.path.join(self.src, 'Makefile')])
+      self.assertEqual(self.audit('--merge', '--max-age', '1'), 0)
+    with open(glob.glob(os.path.join(self.src, '*.json'))[0]) as fp:
+      entry = json.load(fp)['all']
+    self.assertEqual(sorted(entry['PREREQS']), ['Makefile', 'a.c', 'b.c'])
+    self.assertEqual(sorted(entry['INTERMEDIATES']), ['a.o', 'b.o'])
+    self.assertEqual(sorted(entry['TERMINALS']), ['prog'])
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,46 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import prefetch
+from prefetch import Prefetcher
+
+class PrefetchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.names = ['a.c', 'b.c']
+    for name in self.names:
+      with open(os.path.join(self.tmp, name), 'w') as fp:
+        fp.write('int x;\n' * 1000)
+      subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.tmp, name)])
+    self.will_need = prefetch.will_need
+
+  def tearDown(self):
+    prefetch.will_need = self.will_need
+    shutil.rmtree(self.tmp)
+
+  def test_advises_without_reading(self):
+    advised = []
+    def will_need(fd):
+      advised.append(fd)
+      self.will_need(fd)
+    prefetch.will_need = will_need
+    fetcher = Prefetcher(self.tmp, self.names + ['missing.c'])
+    fetcher.run()
+    self.assertEqual(fetcher.fetched, 2)
+    self.assertEqual(len(advised), 2)
+    for name in self.names:
+      atime = os.stat(os.path.join(self.tmp, name)).st_atime
+      self.assertEqual(atime, os.stat(os.path.join(self.tmp, name)).st_mtime)
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
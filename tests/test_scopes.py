@@ -0,0 +1,115 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from scopes import overlaps
+
+AUDITRUN = os.path.join(HERE, 'auditrun.py')
+
+def write(path, text, age=0):
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as fp:
+    fp.write(text)
+  if age:
+    then = time.time() - age
+    os.utime(path, (then, then))
+
+def read(path):
+  with open(path) as fp:
+    return fp.read()
+
+class OverlapTest(unittest.TestCase):
+
+  def test_overlaps(self):
+    self.assertTrue(overlaps('a', 'a'))
+    self.assertTrue(overlaps('a', 'a/b'))
+    self.assertTrue(overlaps('.', 'b'))
+    self.assertFalse(overlaps('a', 'b'))
+    self.assertFalse(overlaps('a', 'ab'))
+
+class ScopedAuditTest(unittest.TestCase):
+  """Scoped audits of subdirectories a and b of one tree."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.ext = os.path.join(self.tmp, 'ext')
+    # The source tree holds stale targets from some earlier build.
+    write(os.path.join(self.src, 'a', 'Makefile'), 'all:\n\tcat in.txt > out.txt\n\tsleep 3\n', age=60)
+    write(os.path.join(self.src, 'b', 'Makefile'), 'all:\n\tcat in.txt > out.txt\n', age=60)
+    for scope in ('a', 'b'):
+      write(os.path.join(self.src, scope, 'in.txt'), 'fresh %s\n' % (scope), age=60)
+      write(os.path.join(self.src, scope, 'out.txt'), 'stale\n', age=60)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def audit(self, scope, *opts):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '--copier', 'native',
+           '-x', self.ext, '--scope', scope, '-k', scope] + list(opts) + ['--', 'make', '-s', '-C', scope]
+    return subprocess.Popen(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                            stderr=subprocess.STDOUT)
+
+  def test_concurrent_copy_out_leaves_other_scopes_alone(self):
+    first = self.audit('a')
+    time.sleep(1.5)  # until a has written its target and is still building
+    second = self.audit('b')
+    self.assertEqual(second.wait(), 0)
+    self.assertEqual(first.wait(), 0)
+    # b's copy-out mustn't have put the stale a/out.txt back over
+    # the one a had just built, which would have left it stale here.
+    self.assertEqual(read(os.path.join(self.src, 'a', 'out.txt')), 'fresh a\n')
+    self.assertEqual(read(os.path.join(self.src, 'b', 'out.txt')), 'fresh b\n')
+
+  def test_reads_outside_scope_not_avoided(self):
+    write(os.path.join(self.src, 'shared.txt'), 'old\n', age=60)
+    write(os.path.join(self.src, 'b', 'Makefile'), 'all:\n\tcat in.txt ../shared.txt > out.txt\n', age=60)
+    self.assertEqual(self.audit('b').wait(), 0)
+    write(os.path.join(self.src, 'shared.txt'), 'new\n')
+    # shared.txt isn't among b's recorded prereqs, so nothing
+    # recorded has changed, but the build must be done again.
+    self.assertEqual(self.audit('b', '--avoid-build').wait(), 0)
+    self.assertEqual(read(os.path.join(self.src, 'b', 'out.txt')), 'fresh b\nnew\n')
+
+class InPlaceScopeTest(unittest.TestCase):
+  """Scoped audits of a tree built in place, with no external base."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    write(os.path.join(self.src, 'a', 'Makefile'), 'all:\n\tcat in.txt > out.txt\n', age=60)
+    write(os.path.join(self.src, 'a', 'in.txt'), 'a\n', age=60)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def audit(self, scope, subdir):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true',
+           '--scope', scope, '-k', scope, '--', 'make', '-s', '-C', subdir]
+    return subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                           stderr=subprocess.STDOUT)
+
+  def test_registry_stays_in_tree(self):
+    self.assertEqual(self.audit('a', 'a'), 0)
+    self.assertEqual(os.listdir(self.tmp), ['src'])
+    self.assertTrue(os.path.exists(os.path.join(self.src, '.audit-scopes.json')))
+
+  def test_registry_not_audited(self):
+    self.assertEqual(self.audit(os.curdir, 'a'), 0)
+    self.assertEqual(read(os.path.join(self.src, 'a', 'out.txt')), 'a\n')
+    db = read(os.path.join(self.src, 'BuildAudit.json'))
+    self.assertIn('a/out.txt', db)
+    self.assertNotIn('audit-scopes', db)
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
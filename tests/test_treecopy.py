@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import treecopy
+from treecopy import TreeCopier
+
+class ShortCopyTest(unittest.TestCase):
+  """Kernel copies which stop short must still leave a whole copy."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.dst = os.path.join(self.tmp, 'dst')
+    with open(self.src, 'wb') as fp:
+      fp.write(os.urandom(300 * 1024))
+    self.saved = treecopy.kernel_copy_range, treecopy.kernel_sendfile
+
+  def tearDown(self):
+    treecopy.kernel_copy_range, treecopy.kernel_sendfile = self.saved
+    shutil.rmtree(self.tmp)
+
+  def copy(self):
+    TreeCopier().copy_data(self.src, self.dst, os.stat(self.src))
+    with open(self.src, 'rb') as a:
+      with open(self.dst, 'rb') as b:
+        self.assertTrue(a.read() == b.read())
+
+  def test_copy_file_range_stops_short(self):
+    def copy_range(ifd, ofd, offset, count):
+      if offset >= 4096:
+        return 0
+      return self.saved[0](ifd, ofd, offset, min(count, 4096 - offset))
+    treecopy.kernel_copy_range = copy_range
+    self.copy()
+
+  def test_both_stop_short(self):
+    treecopy.kernel_copy_range = lambda ifd, ofd, offset, count: 0
+    def sendfile(ofd, ifd, offset, count):
+      if offset >= 100 * 1024:
+        return 0
+      return self.saved[1](ofd, ifd, offset, min(count, 100 * 1024 - offset))
+    treecopy.kernel_sendfile = sendfile
+    self.copy()
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,47 @@
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+AUDITRUN = os.path.join(HERE, 'auditrun.py')
+
+class VerifyTest(unittest.TestCase):
+  """--verify with an external tree, for a build with one volatile target."""
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp, 'src')
+    self.ext = os.path.join(self.tmp, 'ext')
+    os.makedirs(self.src)
+    with open(os.path.join(self.src, 'Makefile'), 'w') as fp:
+      fp.write('all: same.txt stamp.txt\nsame.txt: in.txt\n\tcat $< > $@\nstamp.txt: in.txt\n\tdate +%N > $@\n')
+    with open(os.path.join(self.src, 'in.txt'), 'w') as fp:
+      fp.write('input\n')
+    for name in ('Makefile', 'in.txt'):
+      subprocess.check_call(['touch', '-d', '2000-01-01', os.path.join(self.src, name)])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_volatile_found_and_second_tree_removed(self):
+    cmd = [sys.executable, AUDITRUN, '-v', '0', '-U', 'file:///none', '-p', 'true', '--copier', 'native',
+           '-x', self.ext, '-k', 'all', '--fresh', '--verify', '--', 'make', '-s']
+    rc = subprocess.call(cmd, cwd=self.src, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                         stderr=subprocess.STDOUT)
+    self.assertEqual(rc, 0)
+    with open(glob.glob(os.path.join(self.src, '*.json'))[0]) as fp:
+      entry = json.load(fp)['all']
+    self.assertEqual(sorted(entry['VOLATILE']), ['stamp.txt'])
+    # Volatile targets or not, the second tree doesn't outlive the build.
+    self.assertFalse(os.path.exists(self.ext + '.verify' + self.src))
+
+if '__main__' == __name__:
+  unittest.main()
+
+# vim: ts=8:sw=2:tw=120:et:
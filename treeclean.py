@@ -0,0 +1,60 @@
+import errno
+import os
+import threading
+
+from auditutils import format_bytes, parallel_map, verbose
+
+def clean_targets(basedir, rpaths, dry_run=False, jobs=None, prune=True):
+  """Remove the given files from basedir, then (with prune) directories left empty.
+
+  Files are unlinked by a pool of workers, each taking a whole
+  directory at a time so that no two workers contend for the
+  same directory. Missing files are ignored. With dry_run
+  nothing is removed and the same summary is computed from
+  lstat alone. Returns (files, bytes, pruned directories).
+
+  """
+  bydir = {}
+  for rpath in rpaths:
+    bydir.setdefault(os.path.dirname(rpath), []).append(os.path.basename(rpath))
+
+  lock = threading.Lock()
+  totals = [0, 0]
+
+  def clean_dir(dir):
+    files = nbytes = 0
+    for fn in bydir[dir]:
+      path = os.path.join(basedir, dir, fn)
+      try:
+        st = os.lstat(path)
+        if not dry_run:
+          os.remove(path)
+      except OSError:
+        continue
+      files += 1
+      nbytes += st.st_size
+    with lock:
+      totals[0] += files
+      totals[1] += nbytes
+
+  parallel_map(clean_dir, sorted(bydir), jobs)
+
+  pruned = 0
+  if prune and not dry_run:
+    # Deepest first, so a parent emptied by pruning its child goes too.
+    for dir in sorted(bydir, key=lambda d: d.count(os.sep), reverse=True):
+      while dir:
+        try:
+          os.rmdir(os.path.join(basedir, dir))
+        except OSError as e:
+          if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+            verbose("Cannot prune %s: %s" % (dir, e.strerror))
+          break
+        pruned += 1
+        dir = os.path.dirname(dir)
+
+  verbose("%s %d targets (%s)%s" % ('Would remove' if dry_run else 'Removed', totals[0],
+          format_bytes(totals[1]), ", pruned %d empty directories" % (pruned) if pruned else ''))
+  return totals[0], totals[1], pruned
+
+# vim: ts=8:sw=2:tw=120:et:
@@ -0,0 +1,465 @@
+import ctypes
+import errno
+import fcntl
+import fnmatch
+import os
+import stat
+import sys
+import threading
+import time
+
+from auditutils import file_digest, format_bytes, libc_function, parallel_map, run_with_stdin, verbose
+
+# Not all Pythons expose these, but the Linux values are fixed.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+CHUNK = 1024 * 1024
+
+_loff_p = ctypes.POINTER(ctypes.c_int64)
+_copy_file_range = libc_function(['copy_file_range'], ctypes.c_ssize_t,
+                                 [ctypes.c_int, _loff_p, ctypes.c_int, _loff_p, ctypes.c_size_t, ctypes.c_uint])
+_sendfile = libc_function(['sendfile64', 'sendfile'], ctypes.c_ssize_t,
+                          [ctypes.c_int, ctypes.c_int, _loff_p, ctypes.c_size_t])
+
+def _check(n):
+  if n < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+  return n
+
+def kernel_copy_range(ifd, ofd, offset, count):
+  """copy_file_range() between the same offset of two files; returns the bytes copied."""
+  if hasattr(os, 'copy_file_range'):
+    return os.copy_file_range(ifd, ofd, count, offset, offset)
+  if _copy_file_range is None:
+    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+  return _check(_copy_file_range(ifd, ctypes.byref(ctypes.c_int64(offset)), ofd,
+                                 ctypes.byref(ctypes.c_int64(offset)), count, 0))
+
+def kernel_sendfile(ofd, ifd, offset, count):
+  """sendfile() from an offset of ifd to the current position of ofd; returns the bytes copied."""
+  if hasattr(os, 'sendfile'):
+    return os.sendfile(ofd, ifd, offset, count)
+  if _sendfile is None:
+    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+  return _check(_sendfile(ofd, ifd, ctypes.byref(ctypes.c_int64(offset)), count))
+
+# Errors meaning "this kernel call can't do that here", as opposed to real I/O errors.
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+def excluded(rpath, excludes):
+  """Return True if any component of rpath matches an rsync-style exclude.
+
+  As with rsync, a pattern starting with '/' is anchored at the
+  top of the tree instead, and excludes that path and all below.
+
+  """
+  if excludes:
+    for pattern in excludes:
+      if pattern.startswith('/'):
+        anchored = pattern.strip('/')
+        if rpath == anchored or rpath.startswith(anchored + os.sep):
+          return True
+    for part in rpath.split(os.sep):
+      for pattern in excludes:
+        if not pattern.startswith('/') and fnmatch.fnmatch(part, pattern):
+          return True
+  return False
+
+class TreeCopier(object):
+  """Copy files between two trees from a pool of threads.
+
+  This is a built-in alternative to feeding file lists through
+  'rsync -a'. Regular files are copied in the kernel with
+  copy_file_range or sendfile (called through the C library where
+  os lacks them, as Python 2's does), skipping holes in sparse
+  files, and falling back to plain reads and writes. Permissions
+  and timestamps are preserved, symlinks are recreated as symlinks
+  and FIFOs and device nodes with mknod, as rsync -a would do;
+  a device node we may not create is skipped with a warning.
+
+  When both trees share a filesystem, the mode may ask for data
+  to be shared rather than copied: 'reflink' clones files with
+  FICLONE (copy-on-write, so always safe), while 'hardlink' links
+  just the files named in linkable, which should be known to be
+  read-only inputs. Either falls back to a copy file by file.
+  Hard-linked files are remembered so changed_links() can tell
+  whether anything wrote through a link into the source tree.
+
+  Given a SyncManifest, only files whose source changed since
+  the last sync are copied, and each copy is recorded in it.
+  Given an on_copied callback, it's called with each relative
+  path as soon as that file is in place, from the same worker,
+  so post-processing overlaps with the rest of the copy.
+
+  """
+  def __init__(self, jobs=None, mode='copy', linkable=(), manifest=None, on_copied=None):
+    self.jobs = jobs
+    self.mode = mode
+    self.linkable = linkable
+    self.manifest = manifest
+    self.on_copied = on_copied
+    self.reflink = mode == 'reflink'
+    self.lock = threading.Lock()
+    self.files = 0
+    self.bytes = 0
+    self.cloned = 0
+    self.linked = {}
+    self.errors = []
+    self.start = time.time()
+    self.copy_file_range = hasattr(os, 'copy_file_range') or _copy_file_range is not None
+    self.sendfile = hasattr(os, 'sendfile') or _sendfile is not None
+
+  def copy_files(self, srcdir, dstdir, rpaths, excludes=()):
+    """Copy the listed relative paths, like 'rsync -a --files-from=-'.
+
+    As with rsync, whose --files-from implies --dirs rather than
+    --recursive, nothing is ever deleted from the destination here.
+
+    """
+    rpaths = sorted(rp for rp in rpaths if not excluded(rp, excludes))
+    if self.manifest is not None:
+      rpaths = self.manifest.stale(srcdir, rpaths, self.jobs)
+    parallel_map(lambda rp: self.copy_one(srcdir, dstdir, rp), rpaths, self.jobs)
+    self.check()
+
+  def sync_tree(self, srcdir, dstdir, excludes=(), delete=False):
+    """Mirror srcdir into dstdir, like 'rsync -a srcdir/ dstdir'.
+
+    With delete, anything in dstdir not copied from srcdir is
+    removed, including excluded files (--delete --delete-excluded).
+
+    """
+    dirs = []
+    rpaths = []
+    for parent, dir_names, file_names in os.walk(srcdir):
+      rparent = os.path.relpath(parent, srcdir)
+      dir_names[:] = [dn for dn in dir_names if not excluded(os.path.normpath(os.path.join(rparent, dn)), excludes)]
+      for dn in list(dir_names):
+        rpath = os.path.normpath(os.path.join(rparent, dn))
+        if os.path.islink(os.path.join(parent, dn)):
+          dir_names.remove(dn)
+          rpaths.append(rpath)
+        else:
+          dirs.append(rpath)
+      for fn in file_names:
+        if not excluded(fn, excludes):
+          rpaths.append(os.path.normpath(os.path.join(rparent, fn)))
+
+    self.makedirs(dstdir)
+    for rpath in dirs:
+      self.makedirs(os.path.join(dstdir, rpath))
+    to_copy = rpaths
+    if self.manifest is not None:
+      self.manifest.retain(rpaths)
+      to_copy = self.manifest.stale(srcdir, rpaths, self.jobs)
+    parallel_map(lambda rp: self.copy_one(srcdir, dstdir, rp), to_copy, self.jobs)
+
+    if delete:
+      keep = set(dirs)
+      keep.update(rpaths)
+      for parent, dir_names, file_names in os.walk(dstdir, topdown=False):
+        rparent = os.path.relpath(parent, dstdir)
+        for name in file_names + dir_names:
+          rpath = os.path.normpath(os.path.join(rparent, name))
+          if rpath not in keep:
+            path = os.path.join(parent, name)
+            try:
+              if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+              else:
+                os.remove(path)
+            except OSError as e:
+              self.errors.append("cannot delete %s: %s" % (rpath, e.strerror))
+
+    # Directory times last, since populating them changes their mtimes.
+    for rpath in reversed(dirs):
+      try:
+        set_times(os.path.join(dstdir, rpath), os.stat(os.path.join(srcdir, rpath)))
+      except OSError:
+        pass
+    self.check()
+
+  def makedirs(self, path):
+    try:
+      os.makedirs(path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def copy_one(self, srcdir, dstdir, rpath):
+    src = os.path.join(srcdir, rpath)
+    dst = os.path.join(dstdir, rpath)
+    try:
+      st = os.lstat(src)
+      if stat.S_ISDIR(st.st_mode):
+        self.makedirs(dst)
+        return
+      self.makedirs(os.path.dirname(dst))
+      # Never write through an existing file; it may be a hard link.
+      try:
+        os.remove(dst)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+      nbytes = 0
+      if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+      elif stat.S_ISREG(st.st_mode):
+        if not self.share_data(src, dst, rpath, st):
+          nbytes = self.copy_data(src, dst, st)
+          os.chmod(dst, stat.S_IMODE(st.st_mode))
+          set_times(dst, st)
+      else:
+        try:
+          os.mknod(dst, st.st_mode, st.st_rdev)
+        except OSError as e:
+          if e.errno != errno.EPERM:
+            raise
+          verbose("Skipping %s: not permitted to create device nodes" % (rpath))
+          return
+        set_times(dst, st)
+      with self.lock:
+        self.files += 1
+        self.bytes += nbytes
+      if self.manifest is not None:
+        self.manifest.record(rpath, st)
+      if self.on_copied:
+        self.on_copied(rpath)
+    except (IOError, OSError) as e:
+      with self.lock:
+        self.errors.append("%s: %s" % (rpath, e.strerror))
+
+  def share_data(self, src, dst, rpath, st):
+    """Try to reflink or hard link dst to src; return False to request a copy."""
+    if self.mode == 'hardlink' and rpath in self.linkable:
+      try:
+        os.link(src, dst)
+      except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK):
+          raise
+        return False
+      with self.lock:
+        self.linked[rpath] = (st.st_ino, st.st_size, st.st_mtime)
+      return True
+    elif self.reflink:
+      with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+          try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+          except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED + (errno.ENOTTY,):
+              raise
+            self.reflink = False
+            return False
+      os.chmod(dst, stat.S_IMODE(st.st_mode))
+      set_times(dst, st)
+      with self.lock:
+        self.cloned += 1
+      return True
+    return False
+
+  def changed_links(self, srcdir):
+    """Return the hard-linked files which were modified in place since linking."""
+    changed = []
+    for rpath, (ino, size, mtime) in sorted(self.linked.items()):
+      try:
+        st = os.lstat(os.path.join(srcdir, rpath))
+      except OSError:
+        continue
+      if st.st_ino == ino and (st.st_size != size or st.st_mtime != mtime):
+        changed.append(rpath)
+    return changed
+
+  def copy_data(self, src, dst, st):
+    with open(src, 'rb') as fsrc:
+      with open(dst, 'wb') as fdst:
+        ifd = fsrc.fileno()
+        ofd = fdst.fileno()
+        copied = 0
+        for offset, length in data_segments(ifd, st.st_size):
+          self.copy_range(ifd, ofd, offset, length)
+          copied += length
+        # Extends the file over any trailing hole.
+        os.ftruncate(ofd, st.st_size)
+    return copied
+
+  def copy_range(self, ifd, ofd, offset, length):
+    """Copy length bytes at offset from ifd to the same offset of ofd.
+
+    copy_file_range() and sendfile() may stop short on some kernels
+    and filesystems, returning 0 without failing, so whatever one
+    method leaves is handed to the next, down to read() and write();
+    only EOF on the source ends the copy early.
+
+    """
+    if self.copy_file_range:
+      try:
+        while length > 0:
+          n = kernel_copy_range(ifd, ofd, offset, length)
+          if n == 0:
+            break
+          offset += n
+          length -= n
+      except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+          raise
+        self.copy_file_range = False
+      if length == 0:
+        return
+    os.lseek(ofd, offset, os.SEEK_SET)
+    if self.sendfile:
+      try:
+        while length > 0:
+          n = kernel_sendfile(ofd, ifd, offset, min(length, CHUNK * 64))
+          if n == 0:
+            break
+          offset += n
+          length -= n
+      except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+          raise
+        self.sendfile = False
+      if length == 0:
+        return
+      os.lseek(ofd, offset, os.SEEK_SET)
+    os.lseek(ifd, offset, os.SEEK_SET)
+    while length > 0:
+      buf = os.read(ifd, min(length, CHUNK))
+      if not buf:
+        break
+      length -= len(buf)
+      while buf:
+        buf = buf[os.write(ofd, buf):]
+
+  def check(self):
+    """Report accumulated errors and bail out as a failed rsync would."""
+    if self.errors:
+      for error in self.errors:
+        print >> sys.stderr, "copy error:", error
+      sys.exit(2)
+
+  def report(self, label):
+    seconds = max(time.time() - self.start, 0.001)
+    shared_str = ''
+    if self.cloned or self.linked:
+      shared_str = ", %d reflinked, %d hard-linked" % (self.cloned, len(self.linked))
+    verbose("%s: %d files, %s copied in %.1fs (%d files/s, %s/s)%s" % (label, self.files,
+      format_bytes(self.bytes), seconds, self.files / seconds, format_bytes(self.bytes / seconds), shared_str))
+
+def data_segments(fd, size):
+  """Generate (offset, length) pairs covering the data regions of a file."""
+  if size == 0:
+    return
+  if SEEK_DATA is None:
+    yield 0, size
+    return
+  pos = 0
+  while pos < size:
+    try:
+      data = os.lseek(fd, pos, SEEK_DATA)
+      hole = os.lseek(fd, data, SEEK_HOLE)
+    except OSError as e:
+      if e.errno == errno.ENXIO:
+        return  # nothing but a hole from here to EOF
+      # Hole detection is unsupported here; treat the rest as data.
+      yield pos, size - pos
+      return
+    hole = min(hole, size)
+    if hole > data:
+      yield data, hole - data
+    pos = hole
+
+def set_times(path, st):
+  try:
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+  except (AttributeError, TypeError):
+    os.utime(path, (st.st_atime, st.st_mtime))
+
+def changed_files(srcdir, dstdir, rpaths, jobs=None, hasher=None, transform=None):
+  """Return the subset of rpaths whose copy in dstdir differs from srcdir.
+
+  Sizes, modes and link targets are compared first; only files
+  which agree on all of those are hashed, in parallel, through
+  hasher (a HashCache) if one is given. A source file for which
+  transform(path) returns data, rather than None, is compared
+  as that data, i.e. as it will be once copied and fixed up.
+
+  """
+  def differs(rpath):
+    src = os.path.join(srcdir, rpath)
+    dst = os.path.join(dstdir, rpath)
+    try:
+      sst = os.lstat(src)
+      dst_st = os.lstat(dst)
+      if stat.S_IFMT(sst.st_mode) != stat.S_IFMT(dst_st.st_mode):
+        return True
+      if stat.S_ISLNK(sst.st_mode):
+        return os.readlink(src) != os.readlink(dst)
+      data = transform(src) if transform else None
+      if data is not None:
+        if len(data) != dst_st.st_size or stat.S_IMODE(sst.st_mode) != stat.S_IMODE(dst_st.st_mode):
+          return True
+        with open(dst, 'rb') as fp:
+          return fp.read() != data
+      if sst.st_size != dst_st.st_size or stat.S_IMODE(sst.st_mode) != stat.S_IMODE(dst_st.st_mode):
+        return True
+      if hasher:
+        return hasher.digest(src, sst) != hasher.digest(dst, dst_st)
+      return file_digest(src) != file_digest(dst)
+    except (IOError, OSError):
+      return True
+
+  rpaths = sorted(rpaths)
+  return [rp for rp, diff in zip(rpaths, parallel_map(differs, rpaths, jobs)) if diff]
+
+def copy_files(srcdir, dstdir, rpaths, excludes=(), delete=False, copier='rsync', label='Copy',
+               mode='copy', linkable=(), manifest=None, on_copied=None):
+  """Copy a list of files between trees with the selected copier.
+
+  Returns the TreeCopier used, or None when rsync did the work.
+  With rsync, on_copied can only be applied once it has finished.
+
+  """
+  tc = None
+  if copier == 'native' or mode != 'copy' or manifest is not None:
+    tc = TreeCopier(mode=mode, linkable=linkable, manifest=manifest, on_copied=on_copied)
+    tc.copy_files(srcdir, dstdir, rpaths, excludes)
+    tc.report(label)
+  else:
+    cmd = ['rsync', '-a', '--files-from=-']
+    if delete:
+      cmd.extend(['--delete', '--delete-excluded'])
+    cmd.extend(['--exclude=' + x for x in excludes])
+    cmd.extend([srcdir + os.sep, dstdir])
+    run_with_stdin(cmd, rpaths)
+    if on_copied:
+      parallel_map(on_copied, [rp for rp in rpaths if not excluded(rp, excludes)])
+  return tc
+
+def sync_tree(srcdir, dstdir, excludes=(), delete=False, copier='rsync', label='Copy',
+              mode='copy', linkable=(), manifest=None):
+  """Mirror one tree into another with the selected copier.
+
+  Returns the TreeCopier used, or None when rsync did the work.
+
+  """
+  tc = None
+  if copier == 'native' or mode != 'copy' or manifest is not None:
+    tc = TreeCopier(mode=mode, linkable=linkable, manifest=manifest)
+    tc.sync_tree(srcdir, dstdir, excludes, delete)
+    tc.report(label)
+  else:
+    cmd = ['rsync', '-a']
+    if delete:
+      cmd.extend(['--delete', '--delete-excluded'])
+    cmd.extend(['--exclude=' + x for x in excludes])
+    cmd.extend([srcdir + os.sep, dstdir])
+    run_with_stdin(cmd, [])
+  return tc
+
+# vim: ts=8:sw=2:tw=120:et:
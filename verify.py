@@ -0,0 +1,88 @@
+import errno
+import os
+
+from auditutils import parallel_map, verbose
+from treecopy import sync_tree
+
+CHUNK = 64 * 1024
+
+def first_difference(a, b):
+  """Return the offset of the first byte at which two files differ, or None if they're identical."""
+  offset = 0
+  with open(a, 'rb') as fa:
+    with open(b, 'rb') as fb:
+      while True:
+        ba = fa.read(CHUNK)
+        bb = fb.read(CHUNK)
+        if ba != bb:
+          for i, (x, y) in enumerate(zip(ba, bb)):
+            if x != y:
+              return offset + i
+          return offset + min(len(ba), len(bb))
+        if not ba:
+          return None
+        offset += len(ba)
+
+def file_type(rpath):
+  """Group files by extension, as the tool which made them usually shows."""
+  return os.path.splitext(rpath)[1] or '(none)'
+
+def prepare_tree(srcdir, dstdir, targets, excludes=(), copier='rsync'):
+  """Mirror srcdir into dstdir less the given targets, so a build there makes them all afresh."""
+  sync_tree(srcdir, dstdir, excludes, delete=True, copier=copier, label='Verify copy-out')
+  def remove(rpath):
+    try:
+      os.remove(os.path.join(dstdir, rpath))
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+  parallel_map(remove, sorted(targets))
+
+def compare_trees(dir_a, dir_b, rpaths, jobs=None):
+  """Return {rpath: offset} for the files whose contents differ between two trees.
+
+  The offset is that of the first differing byte; a file missing
+  from either tree is left out, since it says nothing about
+  the contents.
+
+  """
+  def compare(rpath):
+    a = os.path.join(dir_a, rpath)
+    b = os.path.join(dir_b, rpath)
+    if os.path.islink(a) or os.path.islink(b):
+      return None
+    try:
+      return first_difference(a, b)
+    except IOError:
+      verbose("Verify: %s was not built both times" % (rpath))
+      return None
+  rpaths = sorted(rpaths)
+  return dict((rp, off) for rp, off in zip(rpaths, parallel_map(compare, rpaths, jobs)) if off is not None)
+
+def compare_digests(old, new, prereqs, targets):
+  """Return {rpath: None} for targets whose recorded digest changed though no prereq's did.
+
+  Returns None when the prereqs differ, or either build lacks a
+  digest for one of them, so there's nothing to conclude.
+
+  """
+  if not prereqs or [rp for rp in prereqs if rp not in old or old.get(rp) != new.get(rp)]:
+    return None
+  return dict((rp, None) for rp in targets if rp in old and rp in new and old[rp] != new[rp])
+
+def report(key, volatile, checked):
+  """Describe the volatile targets of key by file type."""
+  if not volatile:
+    verbose("Verify: all %d targets of '%s' were rebuilt identically" % (checked, key))
+    return
+  verbose("Verify: %d of %d targets of '%s' differ despite identical prereqs:" % (len(volatile), checked, key))
+  bytype = {}
+  for rpath in volatile:
+    bytype.setdefault(file_type(rpath), []).append(rpath)
+  for ftype, rpaths in sorted(bytype.items(), key=lambda item: (-len(item[1]), item[0])):
+    verbose("  %s (%d):" % (ftype, len(rpaths)))
+    for rpath in sorted(rpaths):
+      offset = volatile[rpath]
+      verbose("    %s%s" % (rpath, '' if offset is None else ' from byte %d (0x%x)' % (offset, offset)))
+
+# vim: ts=8:sw=2:tw=120:et:
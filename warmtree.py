@@ -0,0 +1,198 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from auditutils import format_bytes, load_json, mtime_ns, parallel_map, pid_alive, update_json, verbose, write_json
+
+class SyncManifest(object):
+  """Record what was last synced into a persistent external build tree.
+
+  For each file copied out, the manifest keeps the size, mtime
+  (in ns) and inode the source had at the time of the copy. On
+  the next copy-out only files whose source stat no longer
+  matches need to be transferred, which takes just one lstat
+  per file on the source side and none on the external side.
+  The manifest lives beside, not inside, the external tree so
+  it never shows up in an audit.
+
+  """
+  def __init__(self, build_base):
+    self.path = build_base.rstrip(os.sep) + '.sync.json'
+    self.lock = threading.Lock()
+    self.entries = load_json(self.path)
+
+  @staticmethod
+  def signature(st):
+    return [st.st_size, mtime_ns(st), st.st_ino]
+
+  def stale(self, srcdir, rpaths, jobs=None):
+    """Return those rpaths whose source no longer matches the manifest."""
+    def changed(rpath):
+      try:
+        st = os.lstat(os.path.join(srcdir, rpath))
+      except OSError:
+        return True
+      return self.entries.get(rpath) != self.signature(st)
+
+    rpaths = sorted(rpaths)
+    results = [rp for rp, c in zip(rpaths, parallel_map(changed, rpaths, jobs)) if c]
+    verbose("Warm tree: %d of %d files out of date" % (len(results), len(rpaths)))
+    return results
+
+  def record(self, rpath, st):
+    with self.lock:
+      self.entries[rpath] = self.signature(st)
+
+  def refresh(self, srcdir, rpaths):
+    """Re-record files known to be identical on both sides, e.g. after copy-in."""
+    for rpath in rpaths:
+      try:
+        self.record(rpath, os.lstat(os.path.join(srcdir, rpath)))
+      except OSError:
+        self.forget([rpath])
+
+  def forget(self, rpaths):
+    with self.lock:
+      for rpath in rpaths:
+        self.entries.pop(rpath, None)
+
+  def retain(self, rpaths):
+    """Drop entries for anything not in rpaths."""
+    with self.lock:
+      keep = set(rpaths)
+      for rpath in [rp for rp in self.entries if rp not in keep]:
+        del self.entries[rpath]
+
+  def save(self):
+    write_json(self.path, self.entries)
+
+  def remove(self):
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+class TreeCache(object):
+  """Manage the external build trees under one external base as a cache.
+
+  A registry beside the trees records each tree's size, when
+  it was last used and which process (if any) is using it.
+  When the total exceeds a budget the least recently used idle
+  trees are evicted. Eviction only renames a tree out of the way;
+  the actual deletion runs in a detached background process.
+  All registry updates happen under an exclusive file lock, so
+  any number of builds may share the same external base.
+
+  """
+  def __init__(self, external_base):
+    self.external_base = external_base
+    self.path = os.path.join(external_base, '.audit-trees.json')
+    self.trash = os.path.join(external_base, '.audit-trash')
+
+  def _locked(self, update):
+    """Run update(trees) with the registry loaded and locked; save and return its result."""
+    return update_json(self.path, update)
+
+  @classmethod
+  def users(cls, entry):
+    """Return the live processes using a tree; scoped audits may share one."""
+    pids = entry.get('pids') or [entry.get('pid')]
+    return [pid for pid in pids if pid and pid_alive(pid)]
+
+  @classmethod
+  def in_use(cls, entry):
+    return bool(cls.users(entry))
+
+  @staticmethod
+  def measure(tree):
+    total = 0
+    for parent, dir_names, file_names in os.walk(tree):
+      for name in file_names + dir_names:
+        try:
+          total += os.lstat(os.path.join(parent, name)).st_blocks * 512
+        except OSError:
+          pass
+    return total
+
+  def acquire(self, tree):
+    """Mark a tree as in use by this process."""
+    def update(trees):
+      entry = trees.setdefault(tree, {'size': 0})
+      entry['last_used'] = time.time()
+      entry['pids'] = self.users(entry) + [os.getpid()]
+      entry.pop('pid', None)
+    self._locked(update)
+
+  def release(self, tree, budget=None, size=None):
+    """Record a tree's size now that we're done with it, then enforce the budget.
+
+    The size may be given, e.g. as totalled by the audit. Otherwise
+    the tree is only measured if there's a budget to enforce, and
+    keeps the size last recorded for it if not.
+
+    """
+    if size is None and budget is not None:
+      size = self.measure(tree) if os.path.exists(tree) else 0
+    def update(trees):
+      entry = trees.setdefault(tree, {'size': 0})
+      pids = [pid for pid in self.users(entry) if pid != os.getpid()]
+      entry.update({'last_used': time.time(), 'pids': pids})
+      if size is not None:
+        entry['size'] = size
+      entry.pop('pid', None)
+      return self._evict(trees, budget, keep=tree) if budget is not None else []
+    for victim in self._locked(update):
+      verbose("Evicting external tree %s" % (victim))
+
+  def forget(self, tree):
+    self._locked(lambda trees: trees.pop(tree, None))
+
+  def remove(self, tree):
+    """Stop managing a tree and delete it in the background."""
+    self.forget(tree)
+    self.discard(tree)
+
+  def _evict(self, trees, budget, keep):
+    victims = []
+    total = sum(entry.get('size', 0) for entry in trees.values())
+    for tree in sorted(trees, key=lambda t: trees[t].get('last_used', 0)):
+      if total <= budget:
+        break
+      if tree == keep or self.in_use(trees[tree]):
+        continue
+      total -= trees[tree].get('size', 0)
+      del trees[tree]
+      self.discard(tree)
+      victims.append(tree)
+    return victims
+
+  def discard(self, tree):
+    """Move a tree and its manifest into the trash and delete them in the background."""
+    if not os.path.exists(self.trash):
+      os.makedirs(self.trash)
+    doomed = [tempfile.mkdtemp(dir=self.trash)]
+    for path in (tree, SyncManifest(tree).path):
+      if os.path.lexists(path):
+        try:
+          os.rename(path, os.path.join(doomed[0], os.path.basename(path)))
+        except OSError:
+          doomed.append(path)  # on another filesystem; delete it where it is
+    subprocess.Popen(['rm', '-rf'] + doomed, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                     stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
+  def status(self, budget=None):
+    """Print a table of managed trees, most recently used first."""
+    trees = self._locked(lambda trees: dict(trees))
+    total = 0
+    for tree in sorted(trees, key=lambda t: trees[t].get('last_used', 0), reverse=True):
+      entry = trees[tree]
+      total += entry.get('size', 0)
+      when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.get('last_used', 0)))
+      state = 'in use' if self.in_use(entry) else 'idle'
+      print "%10s  %s  %-6s  %s" % (format_bytes(entry.get('size', 0)), when, state, tree)
+    budget_str = " of %s budget" % (format_bytes(budget)) if budget is not None else ''
+    print "%10s  total in %d trees%s" % (format_bytes(total), len(trees), budget_str)
+
+# vim: ts=8:sw=2:tw=120:et: